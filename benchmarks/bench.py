@@ -0,0 +1,290 @@
+"""
+Benchmark suite for keycmd
+
+Builds synthetic configuration trees in a temporary folder, resolves
+them against a fake keyring backend with configurable latency, and
+writes the timings of every scenario as JSON, e.g.:
+
+    python benchmarks/bench.py --latency 0.02 --output results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import keyring
+from keyring.errors import KeyringError
+
+import keycmd.cache
+import keycmd.conf
+from keycmd import KeycmdError, __version__
+from keycmd.conf import load_conf
+from keycmd.creds import get_env
+from keycmd.shell import get_shell
+
+HERE = Path(__file__).parent
+sys.path.insert(0, str(HERE))
+
+# errors of a single run, e.g. simulated by --failure-rate, which are
+# counted instead of aborting the benchmark
+RUN_ERRORS = (KeyringError, KeycmdError, subprocess.CalledProcessError)
+
+from fake_keyring import FakeKeyring  # noqa: E402
+
+cli = argparse.ArgumentParser(prog="bench", description=__doc__.split("\n\n")[0])
+cli.add_argument("--repeat", type=int, default=5, help="runs per scenario")
+cli.add_argument("--latency", type=float, default=0.02, help="seconds per lookup")
+cli.add_argument("--jitter", type=float, default=0.005, help="max extra seconds")
+cli.add_argument("--failure-rate", type=float, default=0.0, help="0 to 1")
+cli.add_argument("--keys", type=int, default=200, help="number of keys")
+cli.add_argument("--aliases", type=int, default=200, help="number of aliases")
+cli.add_argument("--depth", type=int, default=20, help="depth of folder tree")
+cli.add_argument("--layers", type=int, default=10, help="number of .keycmd files")
+cli.add_argument("--pyproject-kb", type=int, default=64, help="pyproject.toml size")
+cli.add_argument("--output", default="-", help="JSON output path, - for stdout")
+
+
+def make_tree(root, keys, aliases, depth, layers, pyproject_kb):
+    """
+    Create a synthetic config tree: a chain of nested folders, with
+    .keycmd files spread over the chain and a large pyproject.toml at
+    the root. Returns the deepest folder.
+    """
+    (root / ".git").mkdir()
+    user_dir = root / "user"
+    user_dir.mkdir()
+    (user_dir / ".keycmd").write_text(
+        '[keys]\nUSER_KEY = { credential = "user", username = "user" }\n',
+        encoding="utf-8",
+    )
+
+    folders = [root]
+    for i in range(depth):
+        folders.append(folders[-1] / f"level{i}")
+    folders[-1].mkdir(parents=True)
+
+    # spread keys and aliases over the layers, later layers
+    # also override the first key
+    step = max(1, len(folders) // max(1, layers))
+    layer_folders = folders[::step][:layers]
+    for n, folder in enumerate(layer_folders):
+        lines = ["[keys]"]
+        if n > 0:
+            lines.append(f'KEY_0 = {{ credential = "cred0", username = "user{n}" }}')
+        for i in range(n, keys, max(1, layers)):
+            lines.append(
+                f'KEY_{i} = {{ credential = "cred{i % (keys // 2 or 1)}",'
+                f' username = "user{n}" }}'
+            )
+        lines.append("[aliases]")
+        for i in range(n, aliases, max(1, layers)):
+            lines.append(
+                f'ALIAS_{i} = {{ key = "KEY_{i % keys}",'
+                f' format = "{{username}}:{{password}}", b64 = true }}'
+            )
+        (folder / ".keycmd").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    # a large pyproject.toml with a small [tool.keycmd] section
+    lines = [
+        "[project]",
+        'name = "bench"',
+        "[tool.keycmd.keys]",
+        'PYPROJECT_KEY = { credential = "pyproject", username = "user" }',
+    ]
+    i = 0
+    while sum(map(len, lines)) < pyproject_kb * 1024:
+        lines.append(f"[[tool.poetry.package]]\nname = 'package{i}'")
+        lines.append(f'version = "1.0.{i}"\nfiles = [{{ file = "p{i}.whl" }}]')
+        i += 1
+    (root / "pyproject.toml").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return user_dir, folders[-1]
+
+
+@contextmanager
+def environment(root, user_dir, cwd, backend):
+    """Point keycmd at the synthetic tree and the fake keyring"""
+    old_cwd = Path.cwd()
+    old_userprofile = keycmd.conf.USERPROFILE
+    old_cache_dir = keycmd.cache.CACHE_DIR
+    old_backend = keyring.get_keyring()
+    old_environ = os.environ.copy()
+    os.chdir(cwd)
+    # make sure a running agent doesn't affect the results
+    os.environ["KEYCMD_AGENT_SOCK"] = str(root / "agent.sock")
+    keycmd.conf.USERPROFILE = user_dir
+    keycmd.cache.CACHE_DIR = root / "cache"
+    keyring.set_keyring(backend)
+    try:
+        yield
+    finally:
+        os.chdir(old_cwd)
+        keycmd.conf.USERPROFILE = old_userprofile
+        keycmd.cache.CACHE_DIR = old_cache_dir
+        keyring.set_keyring(old_backend)
+        os.environ.clear()
+        os.environ.update(old_environ)
+
+
+def measure(name, func, repeat, **params):
+    """
+    Time a function, returning a result record. Failed runs are counted
+    as errors and left out of the timings.
+    """
+    timings = []
+    errors = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            func()
+        except RUN_ERRORS:
+            errors += 1
+            continue
+        timings.append(time.perf_counter() - start)
+    result = {
+        "name": name,
+        "params": params,
+        "repeat": repeat,
+        "errors": errors,
+        "min": min(timings, default=None),
+        "median": statistics.median(timings) if timings else None,
+        "mean": statistics.mean(timings) if timings else None,
+        "max": max(timings, default=None),
+    }
+    if timings:
+        summary = f"{result['median'] * 1000:.2f} ms (median)"
+    else:
+        summary = "all runs failed"
+    if errors:
+        summary += f", {errors} of {repeat} runs failed"
+    print(f"{name}: {summary}", file=sys.stderr)
+    return result
+
+
+def run_cli(args, cwd, env):
+    """Run the keycmd CLI in a fresh interpreter"""
+    code = "import sys; from keycmd.cli import main; main(sys.argv[1:])"
+    subprocess.run(
+        [sys.executable, "-c", code, *args],
+        cwd=cwd,
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def run(args):
+    results = []
+    repeat = args.repeat
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp).resolve()
+        user_dir, cwd = make_tree(
+            root, args.keys, args.aliases, args.depth, args.layers, args.pyproject_kb
+        )
+        backend = FakeKeyring(
+            latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate
+        )
+        tree = {
+            "depth": args.depth,
+            "layers": args.layers,
+            "keys": args.keys,
+            "aliases": args.aliases,
+            "pyproject_kb": args.pyproject_kb,
+        }
+        lookup = {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "failure_rate": args.failure_rate,
+        }
+
+        with environment(root, user_dir, cwd, backend):
+            results.append(measure("load_conf", load_conf, repeat, **tree))
+            load_conf(use_cache=True)
+            results.append(
+                measure(
+                    "load_conf_cached",
+                    lambda: load_conf(use_cache=True),
+                    repeat,
+                    **tree,
+                )
+            )
+
+            for max_workers in (1, 8, 32):
+                conf = dict(load_conf(), settings={"max_workers": max_workers})
+                results.append(
+                    measure(
+                        "get_env",
+                        lambda conf=conf: get_env(conf),
+                        repeat,
+                        max_workers=max_workers,
+                        **tree,
+                        **lookup,
+                    )
+                )
+
+            results.append(measure("get_shell", get_shell, repeat))
+            get_shell(use_cache=True)
+            results.append(
+                measure("get_shell_cached", lambda: get_shell(use_cache=True), repeat)
+            )
+
+        env = os.environ.copy()
+        env.update(
+            {
+                "PYTHONPATH": os.pathsep.join([str(HERE), *sys.path]),
+                "PYTHON_KEYRING_BACKEND": "fake_keyring.FakeKeyring",
+                "KEYRING_PROPERTY_LATENCY": str(args.latency),
+                "KEYRING_PROPERTY_JITTER": str(args.jitter),
+                "KEYRING_PROPERTY_FAILURE_RATE": str(args.failure_rate),
+                "HOME": str(user_dir),
+                "USERPROFILE": str(user_dir),
+                "XDG_CACHE_HOME": str(root / "cache"),
+                "KEYCMD_AGENT_SOCK": str(root / "agent.sock"),
+            }
+        )
+        results.append(
+            measure(
+                "cli_version",
+                lambda: run_cli(["--version"], cwd, env),
+                repeat,
+            )
+        )
+        results.append(
+            measure(
+                "cli_run",
+                lambda: run_cli(["--exec", sys.executable, "--version"], cwd, env),
+                repeat,
+                **tree,
+                **lookup,
+            )
+        )
+
+    return {
+        "keycmd_version": __version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "errors": sum(result["errors"] for result in results),
+        "results": results,
+    }
+
+
+def main(args=None):
+    args = cli.parse_args(args=args)
+    report = json.dumps(run(args), indent=2)
+    if args.output == "-":
+        print(report)
+    else:
+        Path(args.output).write_text(report + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+An in-process keyring backend for benchmarking, which simulates the
+latency, jitter and failures of a real backend.
+
+Properties can be set in the constructor, or through the environment
+with keyring's KEYRING_PROPERTY_* convention, e.g.:
+
+    PYTHON_KEYRING_BACKEND=fake_keyring.FakeKeyring
+    KEYRING_PROPERTY_LATENCY=0.02
+"""
+
+import random
+import time
+
+from keyring.backend import KeyringBackend
+from keyring.errors import KeyringError, PasswordDeleteError
+
+
+class FakeKeyring(KeyringBackend):
+    priority = 0.1
+
+    latency = 0.0
+    jitter = 0.0
+    failure_rate = 0.0
+    seed = None
+
+    def __init__(self, latency=None, jitter=None, failure_rate=None, seed=None):
+        super().__init__()
+        if latency is not None:
+            self.latency = latency
+        if jitter is not None:
+            self.jitter = jitter
+        if failure_rate is not None:
+            self.failure_rate = failure_rate
+        if seed is not None:
+            self.seed = seed
+        self.random = random.Random(self.seed)
+        self.passwords = {}
+        self.calls = 0
+
+    def simulate(self):
+        """Sleep for the configured latency (plus jitter), and fail randomly"""
+        self.calls += 1
+        delay = float(self.latency) + self.random.uniform(0, float(self.jitter))
+        if delay > 0:
+            time.sleep(delay)
+        if self.random.random() < float(self.failure_rate):
+            raise KeyringError("simulated backend failure")
+
+    def get_password(self, service, username):
+        self.simulate()
+        if service.startswith("missing"):
+            return None
+        # passwords that weren't explicitly set are generated, so that
+        # configurations of any size can be resolved without setting them up
+        return self.passwords.get((service, username), f"{service}:{username}")
+
+    def set_password(self, service, username, password):
+        self.simulate()
+        self.passwords[service, username] = password
+
+    def delete_password(self, service, username):
+        self.simulate()
+        try:
+            del self.passwords[service, username]
+        except KeyError:
+            raise PasswordDeleteError("password not found") from None
@@ -1 +1,23 @@
 __version__ = "0.7.0"
+
+from .logs import KeycmdError
+
+__all__ = [
+    "KeycmdError",
+    "__version__",
+    "injected",
+    "invalidate",
+    "resolve",
+    "resolve_async",
+]
+
+# the API is imported lazily, so the CLI doesn't pay for it
+_API = ("injected", "invalidate", "resolve", "resolve_async")
+
+
+def __getattr__(name):
+    if name in _API:
+        from . import api
+
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
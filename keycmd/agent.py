@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from .logs import error, log, vlog
+
+DEFAULT_TTL = 15 * 60
+DEFAULT_IDLE_TIMEOUT = 60 * 60
+CONNECT_TIMEOUT = 1.0
+# unix sockets are available on all posix systems
+IS_SUPPORTED = os.name == "posix"
+
+
+def get_socket_path():
+    """Determine the location of the agent socket"""
+    path = os.environ.get("KEYCMD_AGENT_SOCK")
+    if path:
+        return Path(path)
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / "keycmd" / "agent.sock"
+    import tempfile
+
+    return Path(tempfile.gettempdir()) / f"keycmd-{os.getuid()}" / "agent.sock"
+
+
+def request(message, path=None):
+    """
+    Send a request to a running agent and return its response,
+    or None if no agent could be reached
+    """
+    if not IS_SUPPORTED:
+        return None
+    path = path or get_socket_path()
+    if not path.exists():
+        return None
+    if not is_trusted(path):
+        vlog("not using agent at %s, it may belong to another user", path)
+        return None
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(str(path))
+            sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as fh:
+                response = fh.readline()
+    except OSError as err:
+        vlog("agent at %s unavailable: %s", path, err)
+        return None
+    if not response:
+        return None
+    try:
+        return json.loads(response)
+    except ValueError as err:
+        vlog("invalid response from agent at %s: %s", path, err)
+        return None
+
+
+def is_trusted(path):
+    """
+    Check that the socket belongs to the current user, and that neither
+    the socket nor its folder can be replaced by other users
+    """
+    import stat
+
+    uid = os.getuid()
+    try:
+        st = os.stat(path)
+        parent = os.stat(path.parent)
+    except OSError:
+        return False
+    if st.st_uid != uid or st.st_mode & 0o022:
+        return False
+    if parent.st_uid not in (uid, 0):
+        return False
+    # other users can't replace files in folders like /tmp with the sticky bit
+    return not parent.st_mode & 0o022 or bool(parent.st_mode & stat.S_ISVTX)
+
+
+def get_passwords(pairs):
+    """
+    Ask a running agent for the passwords of a list of (credential, username)
+    pairs, returning None if no agent could be reached
+    """
+    response = request({"op": "get", "pairs": [list(pair) for pair in pairs]})
+    if response is None or "passwords" not in response:
+        return None
+    vlog(
+        "resolved %d credentials through agent",
+        len(pairs),
+        event="agent_resolved",
+        count=len(pairs),
+    )
+    return response["passwords"]
+
+
+def flush():
+    """Clear the cache of a running agent"""
+    if request({"op": "flush"}) is None:
+        error(f"no agent running at {get_socket_path()}")
+    log("agent cache flushed")
+
+
+def peer_uid(sock):
+    """Read the uid of the process on the other end of the socket, if supported"""
+    import socket
+    import struct
+
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+class Agent:
+    """Caches passwords for a limited amount of time"""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.last_activity = time.monotonic()
+
+    def get_passwords(self, pairs):
+        from .creds import get_passwords
+
+        now = time.monotonic()
+        self.last_activity = now
+        with self.lock:
+            cached = {
+                pair: password
+                for pair, (expires, password) in self.cache.items()
+                if expires > now
+            }
+        missing = [pair for pair in dict.fromkeys(pairs) if pair not in cached]
+        if missing:
+            vlog("agent fetching %d credentials", len(missing))
+            passwords = dict(zip(missing, get_passwords(missing)))
+            with self.lock:
+                for pair, password in passwords.items():
+                    if password is not None:
+                        self.cache[pair] = (now + self.ttl, password)
+            cached.update(passwords)
+        return [cached[pair] for pair in pairs]
+
+    def flush(self):
+        self.last_activity = time.monotonic()
+        with self.lock:
+            self.cache.clear()
+
+    def handle(self, message):
+        if message.get("op") == "ping":
+            return {"ok": True}
+        if message.get("op") == "get":
+            pairs = [tuple(pair) for pair in message["pairs"]]
+            return {"passwords": self.get_passwords(pairs)}
+        if message.get("op") == "flush":
+            self.flush()
+            vlog("agent cache flushed")
+            return {"ok": True}
+        return {"error": f"unknown op {message.get('op')!r}"}
+
+
+def serve(ttl=DEFAULT_TTL, idle_timeout=DEFAULT_IDLE_TIMEOUT, path=None):
+    """
+    Serve cached credentials over a unix socket that only the current
+    user can access, until no requests have been received for idle_timeout
+    seconds
+    """
+    import socketserver
+
+    if not IS_SUPPORTED:
+        error("the agent is not supported on this platform")
+    uid = os.getuid()
+    if path is None and not os.environ.get("KEYCMD_AGENT_SOCK"):
+        # the folder is private to the agent, a folder chosen by the user
+        # is left alone
+        path = get_socket_path()
+        try:
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            if path.parent.stat().st_uid != uid:
+                error(f"{path.parent} belongs to another user")
+            path.parent.chmod(0o700)
+        except OSError as err:
+            error(f"failed to create {path.parent}: {err}")
+    path = path or get_socket_path()
+    if path.exists():
+        if request({"op": "ping"}, path=path) is not None:
+            error(f"an agent is already running at {path}")
+        path.unlink()
+
+    agent = Agent(ttl=ttl)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            peer = peer_uid(self.connection)
+            if peer is not None and peer != uid:
+                vlog("agent refusing connection from uid %s", peer)
+                return
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                response = agent.handle(json.loads(line))
+            except (ValueError, KeyError, TypeError) as err:
+                response = {"error": str(err)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        timeout = min(1.0, idle_timeout)
+
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(str(path), Handler)
+    finally:
+        os.umask(old_umask)
+    log(f"agent listening on {path} (ttl: {ttl}s, idle timeout: {idle_timeout}s)")
+    try:
+        with server:
+            while time.monotonic() - agent.last_activity < idle_timeout:
+                server.handle_request()
+        vlog("agent idle timeout reached")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        path.unlink(missing_ok=True)
+    log("agent stopped")
@@ -0,0 +1,89 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from .conf import load_conf, select_conf
+from .creds import get_secrets, get_secrets_async
+
+# memoized for the lifetime of the process, see invalidate()
+_confs = {}
+_passwords = {}
+_lock = threading.Lock()
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def get_conf(cwd=None):
+    """Load the merged configuration for a folder, memoized per folder"""
+    cwd = Path.cwd() if cwd is None else Path(cwd).resolve()
+    with _lock:
+        conf = _confs.get(cwd)
+    if conf is None:
+        conf = load_conf(cwd=cwd)
+        with _lock:
+            _confs[cwd] = conf
+    return conf
+
+
+def resolve(cwd=None, profile=None, only=None):
+    """
+    Resolve the secrets configured for a folder (the current working
+    directory by default), returning only the environment variables for
+    keys and aliases. Configuration and secrets are memoized for the
+    lifetime of the process, see invalidate().
+
+    Raises KeycmdError if the configuration is invalid or a credential
+    does not exist.
+    """
+    conf = select_conf(get_conf(cwd), profiles=_as_list(profile), only=_as_list(only))
+    return get_secrets(conf, cache=_passwords)
+
+
+async def resolve_async(cwd=None, profile=None, only=None, timeout=None):
+    """
+    Like resolve(), without blocking the event loop. Keyring lookups run
+    in worker threads, at most max_workers at a time, and may take at most
+    timeout seconds each. Concurrent calls share lookups of the same
+    credential.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    conf = await loop.run_in_executor(None, get_conf, cwd)
+    conf = select_conf(conf, profiles=_as_list(profile), only=_as_list(only))
+    return await get_secrets_async(conf, cache=_passwords, timeout=timeout)
+
+
+@contextmanager
+def injected(cwd=None, profile=None, only=None):
+    """
+    Context manager that exposes the resolved secrets in os.environ,
+    restoring the previous environment on exit
+    """
+    secrets = resolve(cwd=cwd, profile=profile, only=only)
+    previous = {name: os.environ.get(name) for name in secrets}
+    os.environ.update(secrets)
+    try:
+        yield secrets
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def invalidate(conf=True, secrets=True):
+    """Forget memoized configuration and/or secrets"""
+    with _lock:
+        if conf:
+            _confs.clear()
+        if secrets:
+            _passwords.clear()
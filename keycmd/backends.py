@@ -0,0 +1,134 @@
+import time
+
+from .logs import KeycmdError, span, vlog
+
+# loaded backends by name, backends are expensive to load
+_backends = {}
+
+
+def load_backend(name):
+    """Load a keyring backend by its fully qualified class name"""
+    backend = _backends.get(name)
+    if backend is None:
+        from keyring.core import load_keyring
+
+        try:
+            backend = load_keyring(name)
+        except Exception as err:
+            raise KeycmdError(f"INVALID keyring backend {name}: {err}") from err
+        _backends[name] = backend
+    return backend
+
+
+def get_chain(conf):
+    """
+    Read the chain of keyring backends from the settings. Returns None if
+    no chain is configured, otherwise a tuple of a list of
+    (backend, timeout in seconds) tuples and the hedging delay in seconds.
+    """
+    settings = conf.get("settings", {})
+    entries = settings.get("backends")
+    if entries is None:
+        return None
+    if not isinstance(entries, list) or not entries:
+        raise KeycmdError(
+            f"INVALID setting backends {entries!r}, expected a list of backends"
+        )
+    default_timeout = get_seconds(settings, "backend_timeout")
+    chain = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"name": entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+            raise KeycmdError(
+                f"INVALID setting backends entry {entry!r},"
+                " expected a name or a table with a name"
+            )
+        timeout = get_seconds(entry, "timeout", default_timeout)
+        chain.append((load_backend(entry["name"]), timeout))
+    hedge_ms = get_seconds(settings, "hedge_ms")
+    hedge = None if hedge_ms is None else hedge_ms / 1000
+    return chain, hedge
+
+
+def get_seconds(data, name, default=None):
+    """Read an optional, non-negative number from a settings table"""
+    value = data.get(name, default)
+    if value is None:
+        return None
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+        raise KeycmdError(
+            f"INVALID setting {name} {value!r}, expected a non-negative number"
+        )
+    return value
+
+
+def get_password(pair, chain):
+    """
+    Look up the password of a (credential, username) pair in a chain of
+    backends, in order. A backend that fails, times out or doesn't know the
+    password passes the lookup on to the next backend. When hedging, the
+    next backend is also queried whenever the running backends haven't
+    answered within the hedging delay. The first password found wins.
+    """
+    import threading
+    from queue import Empty, SimpleQueue
+
+    backends, hedge = chain
+    credential, username = pair
+    answers = SimpleQueue()
+
+    def lookup(index, backend):
+        try:
+            answers.put((index, backend.get_password(credential, username), None))
+        except Exception as err:
+            answers.put((index, None, err))
+
+    # index -> deadline (or None) of the backends that are being queried
+    running = {}
+    started = 0
+
+    def start_next():
+        nonlocal started
+        backend, timeout = backends[started]
+        vlog(
+            "querying %s for credential %s with user %s", backend, credential, username
+        )
+        running[started] = None if timeout is None else time.monotonic() + timeout
+        # daemon threads, so a backend that hangs can't keep the process alive
+        threading.Thread(target=lookup, args=(started, backend), daemon=True).start()
+        started += 1
+
+    with span("get_password", credential=credential, username=username):
+        start_next()
+        next_hedge = None if hedge is None else time.monotonic() + hedge
+        while running:
+            wakeups = [d for d in running.values() if d is not None]
+            if next_hedge is not None and started < len(backends):
+                wakeups.append(next_hedge)
+            wait = max(0, min(wakeups) - time.monotonic()) if wakeups else None
+            try:
+                index, password, err = answers.get(timeout=wait)
+            except Empty:
+                now = time.monotonic()
+                for index, deadline in list(running.items()):
+                    if deadline is not None and deadline <= now:
+                        vlog("%s timed out", backends[index][0])
+                        del running[index]
+            else:
+                if index not in running:
+                    # answered after timing out
+                    continue
+                del running[index]
+                if password is not None:
+                    return password
+                if err is not None:
+                    vlog("%s failed: %s", backends[index][0], err)
+            now = time.monotonic()
+            if started < len(backends) and (
+                not running or (next_hedge is not None and next_hedge <= now)
+            ):
+                start_next()
+                if hedge is not None:
+                    next_hedge = now + hedge
+    return None
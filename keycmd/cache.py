@@ -0,0 +1,97 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+from . import __version__
+from .logs import vlog
+
+# exposed for testing
+CACHE_DIR = None
+# bump whenever the structure of cached values changes
+CACHE_FORMAT = 2
+# the files keycmd writes to the cache folder: pickled caches, the shell
+# cache (see shell.SHELL_CACHE_FILE) and leftovers of interrupted writes
+CACHE_FILES = ("*.pickle", "*.json", "*.tmp")
+
+
+def get_cache_dir():
+    """Determine the folder in which keycmd stores its caches"""
+    if CACHE_DIR is not None:
+        return Path(CACHE_DIR)
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or Path("~/AppData/Local").expanduser()
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path("~/.cache").expanduser()
+    return Path(base) / "keycmd"
+
+
+def fingerprint(paths):
+    """
+    Identify the current state of a list of files by their path,
+    modification time, size and inode
+    """
+    result = []
+    for path in paths:
+        stat = os.stat(path)
+        result.append((str(path), stat.st_mtime_ns, stat.st_size, stat.st_ino))
+    return tuple(result)
+
+
+def get_cache_path(name, paths):
+    """Determine the cache file for a list of paths"""
+    digest = hashlib.sha256("\0".join(map(str, paths)).encode("utf-8")).hexdigest()
+    return get_cache_dir() / f"{name}-{digest[:32]}.pickle"
+
+
+def read(name, paths):
+    """
+    Read a cached value for a list of paths, returning None if
+    there is no cached value or any of the files changed since
+    """
+    path = get_cache_path(name, paths)
+    try:
+        with path.open("rb") as fh:
+            key, value = pickle.load(fh)
+        current = (__version__, CACHE_FORMAT, fingerprint(paths))
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return None
+    if key != current:
+        vlog("cache %s is stale", path)
+        return None
+    vlog("loaded cache %s", path)
+    return value
+
+
+def write(name, paths, key, value):
+    """
+    Write a value to the cache for a list of paths, with the
+    fingerprint that was taken before the files were read
+    """
+    path = get_cache_path(name, paths)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with tmp_path.open("wb") as fh:
+            pickle.dump(
+                ((__version__, CACHE_FORMAT, key), value), fh, pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, path)
+    except OSError as err:
+        vlog("failed to write cache %s: %s", path, err)
+        tmp_path.unlink(missing_ok=True)
+
+
+def clear():
+    """Remove all cache files, returning the number of files removed"""
+    count = 0
+    cache_dir = get_cache_dir()
+    for pattern in CACHE_FILES:
+        for path in cache_dir.glob(pattern):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                # removed concurrently, e.g. by another keycmd --clear-cache
+                continue
+            count += 1
+    return count
@@ -1,12 +1,21 @@
 import argparse
-
-import tomli
+import os
+import sys
+from contextlib import redirect_stdout
+from functools import partial
+from pathlib import Path
 
 from . import __version__
-from .conf import load_conf
-from .creds import get_env
-from .logs import error, log, set_verbose
-from .shell import run_cmd, run_shell
+from .export import FORMATS, format_env
+from .logs import (
+    KeycmdError,
+    error,
+    log,
+    set_log_sink,
+    set_timings,
+    set_verbose,
+)
+from .shell import get_cmd_args, run_cmd, run_cmds, run_shell, start_detection
 
 cli = argparse.ArgumentParser(
     prog="keycmd",
@@ -18,6 +27,13 @@ cli.add_argument(
     default=False,
     help="enable verbose output, useful for configuration debugging",
 )
+cli.add_argument(
+    "--timings",
+    action="store_true",
+    default=False,
+    help="print how much time was spent in each phase to stderr"
+    " (set KEYCMD_TRACE=path to write a Chrome trace file instead)",
+)
 cli.add_argument(
     "--version", action="store_true", default=False, help="print version info"
 )
@@ -27,29 +43,370 @@ cli.add_argument(
     default=False,
     help="spawn a subshell instead of running a command",
 )
+cli.add_argument(
+    "--profile",
+    action="append",
+    default=[],
+    metavar="NAME",
+    help="only resolve the keys and aliases listed in [profiles.NAME]"
+    " (can be repeated)",
+)
+cli.add_argument(
+    "--only",
+    action="append",
+    default=[],
+    metavar="KEY,...",
+    help="only resolve the given keys and aliases (can be repeated)",
+)
+cli.add_argument(
+    "--export",
+    choices=FORMATS,
+    default=None,
+    help="print the secrets in the given format instead of running a command,"
+    " so they can be evaluated once by a shell or read by another program",
+)
+cli.add_argument(
+    "--commands",
+    metavar="FILE",
+    default=None,
+    help="run every line in FILE (- for stdin) as a command, with secrets"
+    " that are only resolved once",
+)
+cli.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="number of commands to run at the same time with --commands"
+    " (default: number of cpus)",
+)
+cli.add_argument(
+    "--watch",
+    action="store_true",
+    default=False,
+    help="restart the command whenever the configuration or a credential changes",
+)
+cli.add_argument(
+    "--watch-interval",
+    type=float,
+    default=60.0,
+    metavar="SECONDS",
+    help="how often to check the keyring for changed credentials with --watch"
+    " (default: %(default)s)",
+)
+cli.add_argument(
+    "--shell-path",
+    metavar="PATH",
+    default=None,
+    help="use this shell instead of detecting the shell that invoked keycmd",
+)
+cli.add_argument(
+    "--exec",
+    action="store_true",
+    default=False,
+    help="run the command directly instead of in a shell,"
+    " if it doesn't need any shell features",
+)
+cli.add_argument(
+    "--agent",
+    action="store_true",
+    default=False,
+    help="run a credential cache agent, serving secrets over a unix socket",
+)
+cli.add_argument(
+    "--flush",
+    action="store_true",
+    default=False,
+    help="clear the cache of a running agent (use together with --agent)",
+)
+cli.add_argument(
+    "--agent-ttl",
+    type=float,
+    # see agent.DEFAULT_TTL, the agent is only imported when it is used
+    default=15 * 60,
+    help="number of seconds the agent caches a secret (default: %(default)s)",
+)
+cli.add_argument(
+    "--agent-idle-timeout",
+    type=float,
+    # see agent.DEFAULT_IDLE_TIMEOUT
+    default=60 * 60,
+    help="number of idle seconds after which the agent stops (default: %(default)s)",
+)
+cli.add_argument(
+    "--vault",
+    choices=("set", "get", "import"),
+    default=None,
+    help="manage the encrypted vault: set CREDENTIAL USERNAME (reads the"
+    " password from stdin), get CREDENTIAL USERNAME, or import [FILE]"
+    " (a JSON file, or the keyring credentials of the current configuration)",
+)
+cli.add_argument(
+    "--no-cache",
+    action="store_true",
+    default=False,
+    help="don't use the cached configuration or the secrets cached in the"
+    " session keyring, always read the config files and the keyring",
+)
+cli.add_argument(
+    "--clear-cache",
+    action="store_true",
+    default=False,
+    help="remove all cached configuration",
+)
+cli.add_argument(
+    "--root-marker",
+    action="append",
+    default=[],
+    metavar="NAME",
+    help="stop searching for config files at folders containing a file"
+    " with this name (can be repeated)",
+)
 cli.add_argument("command", nargs=argparse.REMAINDER, help="command to run")
 
 
+def read_commands(path):
+    """Read commands from a file (or stdin), one per line"""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        try:
+            lines = Path(path).read_text(encoding="utf-8").splitlines()
+        except OSError as err:
+            error(f"failed to read commands: {err}")
+    # skip empty lines and comments
+    commands = [[line.strip()] for line in lines]
+    return [cmd for cmd in commands if cmd[0] and not cmd[0].startswith("#")]
+
+
+def read_password():
+    """Read a password from stdin, or prompt for it when running interactively"""
+    if sys.stdin.isatty():
+        from getpass import getpass
+
+        return getpass("password: ")
+    return sys.stdin.readline().rstrip("\r\n")
+
+
+def run_vault(args):
+    """Run one of the vault commands"""
+    from . import backends, creds, vault
+    from .conf import load_conf, select_conf
+
+    conf = load_conf(use_cache=not args.no_cache, root_markers=args.root_marker)
+    if args.vault in ("set", "get"):
+        if len(args.command) != 2:
+            error(f"usage: keycmd --vault {args.vault} CREDENTIAL USERNAME")
+        credential, username = args.command
+        if args.vault == "set":
+            vault.set_password(credential, username, read_password(), conf=conf)
+            log(f"stored credential {credential} with user {username}")
+            return
+        (password,) = vault.get_passwords([(credential, username)], conf=conf)
+        if password is None:
+            raise KeycmdError(
+                f"MISSING credential {credential} with user {username}"
+                " as it does not exist"
+            )
+        sys.stdout.write(password + "\n")
+        return
+
+    if len(args.command) > 1:
+        error("usage: keycmd --vault import [FILE]")
+    if args.command:
+        import json
+
+        path = args.command[0]
+        try:
+            if path == "-":
+                data = json.load(sys.stdin)
+            else:
+                data = json.loads(Path(path).read_text(encoding="utf-8"))
+        except (OSError, ValueError) as err:
+            error(f"failed to read secrets to import: {err}")
+        passwords = {
+            (credential, username): password
+            for credential, users in data.items()
+            for username, password in users.items()
+        }
+    else:
+        conf = select_conf(conf, profiles=args.profile, only=get_only(args))
+        pairs = creds.get_pairs(conf)
+        fetched = creds.get_passwords(
+            pairs,
+            max_workers=creds.get_max_workers(conf),
+            chain=backends.get_chain(conf),
+        )
+        passwords = {}
+        for (credential, username), password in zip(pairs, fetched):
+            if password is None:
+                raise KeycmdError(
+                    f"MISSING credential {credential} with user {username}"
+                    " as it does not exist"
+                )
+            passwords[credential, username] = password
+    vault.import_passwords(passwords, conf=conf)
+    log(f"imported {len(passwords)} credentials into {vault.get_vault_path(conf)}")
+
+
+def read_conf(args, on_layer=None):
+    """Load the configuration, restricted to the selected profiles and keys"""
+    from .conf import load_conf, select_conf
+
+    conf = load_conf(
+        use_cache=not args.no_cache, root_markers=args.root_marker, on_layer=on_layer
+    )
+    return select_conf(conf, profiles=args.profile, only=get_only(args))
+
+
+def get_only(args):
+    """Split the --only arguments into a list of key and alias names"""
+    only = [name.strip() for names in args.only for name in names.split(",")]
+    return [name for name in only if name]
+
+
+def detect_shell_early(conf, use_cache=False):
+    """
+    Start detecting the shell while the rest of the configuration is loaded,
+    unless the configuration so far sets a shell or direct execution
+    """
+    settings = conf.get("settings", {})
+    if not settings.get("shell") and not settings.get("exec"):
+        start_detection(use_cache=use_cache)
+
+
+def load(args, resolve=True, on_layer=None):
+    """
+    Load the configuration and resolve the secrets, unless resolve is False.
+    Credentials are looked up while the configuration files are parsed.
+    on_layer is called with the configuration merged so far after every
+    parsed file.
+    """
+    callbacks = [on_layer] if on_layer is not None else []
+    prefetcher = None
+    if resolve:
+        from .prefetch import Prefetcher
+
+        prefetcher = Prefetcher(
+            refresh=args.no_cache, profiles=args.profile, only=get_only(args)
+        )
+        callbacks.append(prefetcher.add_layer)
+
+    def add_layer(conf):
+        for callback in callbacks:
+            callback(conf)
+
+    conf = read_conf(args, on_layer=add_layer)
+    if not resolve:
+        return conf, None
+    from .creds import get_env
+
+    cache = prefetcher.collect(conf)
+    return conf, get_env(conf, cache=cache, refresh=args.no_cache)
+
+
 def main(args=None):
     """CLI entrypoint"""
     args = cli.parse_args(args=args)
+    try:
+        run(args)
+    except KeycmdError as err:
+        error(err)
+
+
+def run(args):
+    """Run the CLI with parsed arguments"""
 
     if args.verbose:
         set_verbose()
 
+    log_sink = os.environ.get("KEYCMD_LOG")
+    if log_sink:
+        set_log_sink(log_sink)
+
+    trace_path = os.environ.get("KEYCMD_TRACE")
+    if args.timings or trace_path:
+        set_timings(summary=args.timings, trace_path=trace_path)
+
     if args.version:
         log(f"v{__version__}")
         return
 
-    try:
-        conf = load_conf()
-    except tomli.TOMLDecodeError as err:
-        error(err)
-    env = get_env(conf)
+    if args.agent:
+        from . import agent
+
+        if args.flush:
+            agent.flush()
+        else:
+            agent.serve(ttl=args.agent_ttl, idle_timeout=args.agent_idle_timeout)
+        return
+
+    if args.clear_cache:
+        from . import cache
+
+        count = cache.clear()
+        log(f"removed {count} cache files from {cache.get_cache_dir()}")
+        return
+
+    if args.vault:
+        run_vault(args)
+        return
+
+    if args.export:
+        # keep stdout clean for the exported variables
+        with redirect_stdout(sys.stderr):
+            conf, env = load(args)
+            sources = {**conf["keys"], **conf.get("aliases", {})}
+            as_files = [name for name, src in sources.items() if src.get("file")]
+            if as_files:
+                error(
+                    f"secret files can't be exported, as they only exist as long"
+                    f" as keycmd runs: {', '.join(as_files)}"
+                )
+        sys.stdout.write(format_env(env, list(sources), args.export))
+        return
+
+    use_cache = not args.no_cache
+    on_layer = None
+    if not args.watch and not args.shell_path and not args.exec:
+        # detect the shell while the secrets are being resolved
+        on_layer = partial(detect_shell_early, use_cache=use_cache)
+
+    conf, env = load(args, resolve=not args.watch, on_layer=on_layer)
+
+    shell = args.shell_path or conf.get("settings", {}).get("shell")
+    direct = args.exec or conf.get("settings", {}).get("exec", False)
+    if args.watch:
+        if not args.command:
+            error("missing command argument")
+        from .watch import watch
 
-    if args.shell:
-        run_shell(env=env)
+        cmd_args = get_cmd_args(
+            args.command, shell=shell, use_cache=use_cache, direct=direct
+        )
+        sys.exit(
+            watch(
+                cmd_args,
+                conf,
+                partial(read_conf, args),
+                root_markers=args.root_marker,
+                interval=args.watch_interval,
+            )
+        )
+    elif args.shell:
+        run_shell(env=env, shell=shell, use_cache=use_cache)
+    elif args.commands:
+        if args.jobs is not None and args.jobs < 1:
+            error(f"invalid number of jobs {args.jobs}, expected at least 1")
+        run_cmds(
+            read_commands(args.commands),
+            env=env,
+            jobs=args.jobs,
+            shell=shell,
+            use_cache=use_cache,
+            direct=direct,
+        )
     elif args.command:
-        run_cmd(args.command, env=env)
+        run_cmd(args.command, env=env, shell=shell, use_cache=use_cache, direct=direct)
     else:
         error("missing command argument")
@@ -1,44 +1,170 @@
+import os
+import re
+from collections.abc import Mapping
 from pathlib import Path
-from pprint import pformat
 
-import tomli
-
-from .logs import vlog
+from . import cache
+from .logs import KeycmdError, is_logging, span, vlog
 
 # exposed for testing
 USERPROFILE = "~"
+# patterns to find the [tool.keycmd] sections in pyproject.toml, see scan_pyproj
+HEADER = re.compile(r"\s*\[\[?([^\[\]]*)\]\]?\s*(#.*)?$")
+KEYCMD_HEADER = re.compile(r"\s*\[\[?\s*tool\s*\.\s*keycmd\s*[.\]]")
+BARE_KEYS = re.compile(r"[A-Za-z0-9_-]+(\s*\.\s*[A-Za-z0-9_-]+)*")
+STRINGS_AND_COMMENTS = re.compile(r'"(?:\\.|[^"\\])*"|\'[^\']*\'|#.*')
 
 
 def load_toml(path):
-    """Load a toml file"""
-    with path.open("rb") as fh:
+    """Load a toml file, raises KeycmdError if it is not valid TOML"""
+    import tomli
+
+    with span("parse", path=str(path)), path.open("rb") as fh:
         try:
             return tomli.load(fh)
-        except tomli.TOMLDecodeError as err:
-            raise tomli.TOMLDecodeError(f"invalid TOML in {path}:\n{err}") from err
+        except (UnicodeDecodeError, tomli.TOMLDecodeError) as err:
+            raise KeycmdError(f"INVALID TOML in {path}:\n{err}") from err
+
+
+def scan_pyproj(text):
+    """
+    Extract the [tool.keycmd] sections from the text of a pyproject.toml file
+    without parsing the rest of it. Returns None if the sections can't be
+    extracted reliably, for example when keycmd is configured with dotted
+    keys or an inline table.
+    """
+    lines = []
+    in_keycmd = False
+    # the header of the current table, the root table has no header
+    table = None
+    # the delimiter of the multiline string that spans the current line
+    in_string = None
+    # the depth of the arrays that span the current line
+    depth = 0
+    for line in text.splitlines(keepends=True):
+        if in_string is not None:
+            if in_keycmd:
+                lines.append(line)
+            elif "keycmd" in line:
+                return None
+            if line.count(in_string) % 2:
+                in_string = None
+                depth += line.count("[") - line.count("]")
+            continue
+        header = HEADER.match(line) if depth == 0 else None
+        if header:
+            table = header.group(1).strip()
+            in_keycmd = KEYCMD_HEADER.match(line) is not None
+            if not in_keycmd and "keycmd" in line and not BARE_KEYS.fullmatch(table):
+                return None
+        elif "keycmd" in line and not in_keycmd:
+            # only the root table and [tool] can define tool.keycmd with
+            # dotted keys or inline tables
+            if table is None or KEYCMD_HEADER.match(line):
+                return None
+            if not BARE_KEYS.fullmatch(table) or "".join(table.split()) == "tool":
+                return None
+        if in_keycmd:
+            lines.append(line)
+        for delim in ('"""', "'''"):
+            if line.count(delim) % 2:
+                if in_string is not None or "\\" in line:
+                    return None
+                in_string = delim
+        if not header and ("[" in line or "]" in line):
+            code = line.split(in_string, 1)[0] if in_string else line
+            code = STRINGS_AND_COMMENTS.sub("", code)
+            depth += code.count("[") - code.count("]")
+    return "".join(lines)
 
 
 def load_pyproj(path):
-    """Load [tool.keycmd] from a pyproject.toml file"""
+    """
+    Load [tool.keycmd] from a pyproject.toml file. Only the keycmd sections
+    are parsed, unless they can't be found reliably.
+    """
+    with span("parse", path=str(path)):
+        data = path.read_bytes()
+        if b"keycmd" not in data:
+            return {}
+        import tomli
+
+        try:
+            text = scan_pyproj(data.decode("utf-8"))
+            if text is not None:
+                return tomli.loads(text).get("tool", {}).get("keycmd", {})
+        except (UnicodeDecodeError, tomli.TOMLDecodeError):
+            pass
+    vlog("parsing all of %s", path)
     data = load_toml(path)
     return data.get("tool", {}).get("keycmd", {})
 
 
-def find_file(fname, first_only=True):
-    """Find a file by walking up the filesystem, starting at cwd"""
-    cur = Path.cwd()
+def scan_dir(path, names):
+    """
+    List which of the given names exist in a folder as files, and whether
+    the folder is the root of a git repository. Returns a tuple of
+    (files, is_git_root, number of filesystem calls), where files maps
+    the names that were found to whether they are symlinks.
+    """
+    files = {}
+    is_git_root = False
+    calls = 1
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name in names:
+                    is_symlink = entry.is_symlink()
+                    calls += is_symlink
+                    if entry.is_file():
+                        files[entry.name] = is_symlink
+                elif entry.name == ".git":
+                    calls += entry.is_symlink()
+                    is_git_root = entry.is_dir()
+    except OSError:
+        # fall back to checking the names one by one, which only
+        # requires search permission on the folder
+        for name in names:
+            calls += 1
+            if (path / name).is_file():
+                calls += 1
+                files[name] = (path / name).is_symlink()
+        is_git_root = (path / ".git").is_dir()
+        calls += 1
+    return files, is_git_root, calls
+
+
+def find_files(fnames, root_markers=(), cwd=None):
+    """
+    Find files by walking up the filesystem once, starting at cwd
+    (the current working directory by default).
+    Returns a dict mapping each file name to the list of paths where it
+    was found, nearest first. The walk stops at the root of a git repository,
+    before the home folder, at the filesystem root and at folders containing
+    any of the root_markers.
+    """
+    cur = Path.cwd() if cwd is None else Path(cwd).resolve()
     home = Path.home()
-    results = []
+    names = set(fnames) | set(root_markers)
+    results = {fname: [] for fname in fnames}
+    total_calls = 0
+    dirs = 0
     while True:
-        candidate = cur / fname
-        if candidate.is_file():
-            hit = candidate.resolve()
-            if first_only:
-                return hit
-            else:
-                results.append(hit)
+        files, is_git_root, calls = scan_dir(cur, names)
+        dirs += 1
+        total_calls += calls
+        for fname in fnames:
+            if fname in files:
+                candidate = cur / fname
+                if files[fname]:
+                    total_calls += 1
+                    candidate = candidate.resolve()
+                results[fname].append(candidate)
         # don't search outside git repositories
-        if (cur / ".git").is_dir():
+        if is_git_root:
+            break
+        # stop at explicitly marked roots
+        if not files.keys().isdisjoint(root_markers):
             break
         # stop before searching the home folder
         if cur.parent == home:
@@ -47,11 +173,24 @@ def find_file(fname, first_only=True):
         if cur.parent == cur:
             break
         cur = cur.parent
-    if not first_only:
-        # return .keycmd files in order in which they should
-        # be loaded and merged
-        results.reverse()
-        return results
+    vlog(
+        "searched %d folders for %s using %d filesystem calls",
+        dirs,
+        ", ".join(fnames),
+        total_calls,
+    )
+    return results
+
+
+def find_file(fname, first_only=True):
+    """Find a file by walking up the filesystem, starting at cwd"""
+    hits = find_files([fname])[fname]
+    if first_only:
+        return hits[0] if hits else None
+    # return .keycmd files in order in which they should
+    # be loaded and merged
+    hits.reverse()
+    return hits
 
 
 def defaults():
@@ -59,52 +198,195 @@ def defaults():
     return {"keys": {}}
 
 
-def merge_conf(a, b):
+class Overlay(Mapping):
     """
-    Merges two deep dictionary structures.
-    All other datatypes are simply overwritten
+    Read-only, layered view of configuration tables, where later layers take
+    precedence. A table (dict) is merged key by key with the tables of
+    earlier layers, recursively. Any other value, including a list, replaces
+    whatever earlier layers set, and a table only merges with the tables set
+    since the last such value. Values are looked up on access, layers are
+    (data, source) tuples.
     """
-    a = a.copy()
-    for key, value in b.items():
-        if isinstance(value, dict):
-            old_value = a.get(key, {})
-            a[key] = merge_conf(old_value, value)
+
+    __slots__ = ("layers",)
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __getitem__(self, key):
+        tables = []
+        for data, source in reversed(self.layers):
+            if key not in data:
+                continue
+            value = data[key]
+            if not isinstance(value, dict):
+                if not tables:
+                    return value
+                break
+            tables.append((value, source))
+        if not tables:
+            raise KeyError(key)
+        tables.reverse()
+        return Overlay(tables)
+
+    def __iter__(self):
+        keys = {}
+        for data, _ in self.layers:
+            keys.update(dict.fromkeys(data))
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Overlay({dict(self)!r})"
+
+    def source(self, key):
+        """Find the source of the layer that last set a key"""
+        for data, source in reversed(self.layers):
+            if key in data:
+                return source
+        raise KeyError(key)
+
+
+def log_sources(conf, prefix=""):
+    """Log every value in the configuration, with the file it came from"""
+    for key, value in conf.items():
+        if isinstance(value, Overlay) and value:
+            log_sources(value, prefix=f"{prefix}{key}.")
         else:
-            a[key] = value
-    return a
+            vlog("%s%s = %r (from %s)", prefix, key, value, conf.source(key))
 
 
-def load_conf():
+def find_conf_files(root_markers=(), cwd=None):
     """
-    Load merged configuration from the following files:
-    - defaults()
-    - ~/.keycmd
-    - all .keycmd found while walking file system up from .
-    - first pyproject.toml found while walking file system up from .
+    Find the configuration files to load, in order, as a list of
+    (path, is_pyproject) tuples
     """
-    conf = defaults()
+    files = []
 
     # ~/.keycmd
     user_keyconf = (Path(USERPROFILE).expanduser() / ".keycmd").resolve()
     if user_keyconf.is_file():
-        vlog(f"loading config file {user_keyconf}")
-        conf = merge_conf(conf, load_toml(user_keyconf))
+        files.append((user_keyconf, False))
+
+    found = find_files(
+        [".keycmd", "pyproject.toml"], root_markers=root_markers, cwd=cwd
+    )
 
-    # .keycmd
-    local_keycmds = find_file(".keycmd", first_only=False)
-    for local_keycmd in local_keycmds:
+    # .keycmd, in the order in which they should be loaded and merged
+    for local_keycmd in reversed(found[".keycmd"]):
         if local_keycmd == user_keyconf:
-            vlog(f"skipping config file {local_keycmd} (already loaded)")
+            vlog("skipping config file %s (already loaded)", local_keycmd)
             continue
-        vlog(f"loading config file {local_keycmd}")
-        conf = merge_conf(conf, load_toml(local_keycmd))
+        files.append((local_keycmd, False))
 
     # pyproject.toml
-    pyproj = find_file("pyproject.toml")
-    if pyproj is not None:
-        vlog(f"loading config file {pyproj}")
-        conf = merge_conf(conf, load_pyproj(pyproj))
+    if found["pyproject.toml"]:
+        files.append((found["pyproject.toml"][0], True))
+
+    return files
+
+
+def load_conf(use_cache=False, root_markers=(), cwd=None, on_layer=None):
+    """
+    Load merged configuration from the following files:
+    - defaults()
+    - ~/.keycmd
+    - all .keycmd found while walking file system up from .
+    - first pyproject.toml found while walking file system up from .
+
+    Where . is the given cwd, or the current working directory. The walk
+    up the file system can be stopped early at folders containing any of
+    the file names in root_markers.
 
-    vlog(f"merged config:\n{pformat(conf)}")
+    The configuration is returned as an Overlay of the files, so the
+    file every value came from can be looked up.
+
+    With use_cache, the merged configuration is cached on disk
+    until any of these files is changed, added or removed.
+
+    on_layer is called with the configuration merged so far every time a
+    file was parsed, so work can start before all files are parsed.
+    """
+    with span("find_files"):
+        files = find_conf_files(root_markers=root_markers, cwd=cwd)
+    paths = [path for path, _ in files]
+
+    conf = None
+    if use_cache:
+        with span("cache_read"):
+            key = cache.fingerprint(paths)
+            conf = cache.read("conf", paths)
+
+    if conf is None:
+        layers = [(defaults(), "defaults")]
+        for path, is_pyproject in files:
+            vlog(
+                "loading config file %s",
+                path,
+                event="config_loaded",
+                path=str(path),
+            )
+            data = load_pyproj(path) if is_pyproject else load_toml(path)
+            layers.append((data, str(path)))
+            if on_layer is not None:
+                on_layer(Overlay(layers))
+        conf = Overlay(layers)
+        if use_cache:
+            cache.write("conf", paths, key, conf)
+
+    if is_logging():
+        vlog("merged config:")
+        log_sources(conf)
 
     return conf
+
+
+def get_selection(conf, profiles=(), only=()):
+    """
+    Determine the names of the keys and aliases listed by the given profiles
+    and the given names, plus the aliases and keys their aliases refer to.
+    Returns None if nothing is selected.
+    """
+    if not profiles and not only:
+        return None
+    names = list(only)
+    for profile in profiles:
+        data = conf.get("profiles", {}).get(profile)
+        if data is None:
+            raise KeycmdError(f"MISSING profile {profile}")
+        names.extend(data.get("keys", []))
+
+    keys = conf["keys"]
+    aliases = conf.get("aliases", {})
+    selected = set()
+    for name in names:
+        if name not in keys and name not in aliases:
+            raise KeycmdError(f"MISSING key or alias {name}")
+        # the alias can't be exposed without the aliases and key it refers to
+        while name in aliases and name not in selected:
+            selected.add(name)
+            name = aliases[name]["key"]
+        selected.add(name)
+    return selected
+
+
+def select_conf(conf, profiles=(), only=()):
+    """
+    Restrict the configuration to the keys and aliases listed by the given
+    profiles and the given names, plus the keys their aliases refer to.
+    The configuration is returned as-is if nothing is selected.
+    """
+    selected = get_selection(conf, profiles=profiles, only=only)
+    if selected is None:
+        return conf
+    vlog(lambda: f"selected keys and aliases: {', '.join(sorted(selected))}")
+
+    keys = conf["keys"]
+    aliases = conf.get("aliases", {})
+    return {
+        **conf,
+        "keys": {k: v for k, v in keys.items() if k in selected},
+        "aliases": {k: v for k, v in aliases.items() if k in selected},
+    }
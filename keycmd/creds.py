@@ -1,9 +1,18 @@
 import base64
+from functools import partial
 from os import environ
+from weakref import WeakKeyDictionary
 
-import keyring
+from . import agent, backends, files, keyctl, vault
+from .logs import KeycmdError, add_secret, span, vlog
 
-from .logs import error, vlog
+DEFAULT_MAX_WORKERS = 8
+SOURCES = ("keyring", "vault")
+FORMAT_FIELDS = ("credential", "username", "password")
+# compiled format strings, see compile_format
+_templates = {}
+# in-flight async lookups per event loop, see get_password_async
+_inflight = WeakKeyDictionary()
 
 
 def b64(value):
@@ -11,60 +20,442 @@ def b64(value):
     return base64.b64encode(value.encode("utf-8")).decode("utf-8")
 
 
-def expose(env, key, credential, username, password, apply_b64, format_string):
-    if format_string:
-        password = format_string.format(
-            credential=credential,
-            username=username,
-            password=password,
-        )
-    if apply_b64:
-        password = b64(password)
-    env[key] = password
+def compile_format(format_string):
+    """
+    Compile a format string into a function of credential, username and
+    password. Plain substitutions are joined directly, anything fancier
+    (conversions, format specs, attribute access) uses str.format.
+    """
+    template = _templates.get(format_string)
+    if template is not None:
+        return template
+    from string import Formatter
 
+    try:
+        parsed = list(Formatter().parse(format_string))
+    except ValueError as err:
+        raise KeycmdError(f"INVALID format string {format_string!r}: {err}") from err
+    # literal strings, and indexes into (credential, username, password)
+    pieces = []
+    is_plain = True
+    for literal, field, spec, conversion in parsed:
+        if literal:
+            pieces.append(literal)
+        if field is None:
+            continue
+        name = field.split(".", 1)[0].split("[", 1)[0]
+        if name not in FORMAT_FIELDS:
+            raise KeycmdError(
+                f"INVALID format string {format_string!r}, unknown field {field!r}"
+            )
+        is_plain = is_plain and name == field and not spec and not conversion
+        pieces.append(FORMAT_FIELDS.index(name))
 
-def get_env(conf):
-    """Load credentials from the OS keyring according to user configuration"""
-    env = environ.copy()
+    if is_plain:
+
+        def template(*values):
+            return "".join(
+                piece if isinstance(piece, str) else values[piece] for piece in pieces
+            )
+
+    else:
+
+        def template(*values):
+            try:
+                return format_string.format(**dict(zip(FORMAT_FIELDS, values)))
+            except (AttributeError, IndexError, KeyError, ValueError) as err:
+                raise KeycmdError(
+                    f"INVALID format string {format_string!r}: {err}"
+                ) from err
 
-    key_data = {}
-    for key, src in conf["keys"].items():
-        password = keyring.get_password(src["credential"], src["username"])
-        if password is None:
-            error(
-                f"MISSING credential {src['credential']}"
-                f" with user {src['username']}"
-                f" as it does not exist"
+    _templates[format_string] = template
+    return template
+
+
+def transform(src, password, format_string, apply_b64, transforms):
+    """
+    Apply a format string and base64 encoding to a password of the key
+    in src, or to the value of an alias of it. Every unique combination
+    of source value, format and b64 is computed only once, by memoizing
+    them in the transforms dict. As the dict holds on to the secrets, it
+    should only live as long as a single call of expose_secrets.
+    """
+    item = (get_pair(src), password, format_string, apply_b64)
+    value = transforms.get(item)
+    if value is None:
+        value = password
+        if format_string:
+            value = compile_format(format_string)(
+                src["credential"], src["username"], password
             )
-        apply_b64 = src.get("b64", False)
-        format_string = src.get("format")
-        key_data[key] = (
-            src["credential"],
-            src["username"],
-            password,
-            apply_b64,
-            format_string,
+        if apply_b64:
+            value = b64(value)
+        add_secret(value)
+        transforms[item] = value
+    return value
+
+
+def sort_aliases(keys, aliases):
+    """
+    Order the aliases so every alias comes after the alias it refers to,
+    if it refers to an alias rather than a key. Every alias is visited
+    once. Raises KeycmdError for missing keys and circular aliases.
+    """
+    order = []
+    done = set()
+    for alias in aliases:
+        chain = []
+        name = alias
+        while name not in done:
+            if name in chain:
+                cycle = " -> ".join([*chain[chain.index(name) :], name])
+                raise KeycmdError(f"CIRCULAR aliases {cycle}")
+            chain.append(name)
+            target = aliases[name]["key"]
+            if target in keys:
+                break
+            if target not in aliases:
+                raise KeycmdError(f"MISSING alias key {target}")
+            name = target
+        chain.reverse()
+        order.extend(chain)
+        done.update(chain)
+    return order
+
+
+def get_max_workers(conf):
+    """Read the size of the credential lookup thread pool from the settings"""
+    max_workers = conf.get("settings", {}).get("max_workers", DEFAULT_MAX_WORKERS)
+    if not isinstance(max_workers, int) or isinstance(max_workers, bool):
+        raise KeycmdError(
+            f"INVALID setting max_workers {max_workers!r}, expected an integer"
+        )
+    if max_workers < 1:
+        raise KeycmdError(
+            f"INVALID setting max_workers {max_workers}, expected at least 1"
+        )
+    return max_workers
+
+
+def get_password(pair, chain=None):
+    """
+    Look up the password of a (credential, username) pair in the keyring,
+    or in the configured chain of backends, see backends.get_chain
+    """
+    if chain is not None:
+        return backends.get_password(pair, chain)
+    import keyring
+
+    credential, username = pair
+    with span("get_password", credential=credential, username=username):
+        return keyring.get_password(credential, username)
+
+
+def get_passwords(pairs, max_workers=DEFAULT_MAX_WORKERS, chain=None):
+    """
+    Look up the passwords for a list of (credential, username) pairs.
+    Backends that can return many secrets in a single round trip may
+    implement `get_passwords(pairs)`, otherwise lookups are performed
+    one pair at a time, concurrently when more than one worker is allowed.
+    With a chain of backends, lookups are always performed one pair at a time.
+    Results are returned in the same order as the pairs.
+    """
+    if not pairs:
+        return []
+    if chain is not None:
+        lookup = partial(get_password, chain=chain)
+        if max_workers == 1 or len(pairs) == 1:
+            return [lookup(pair) for pair in pairs]
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pairs))) as pool:
+            return list(pool.map(lookup, pairs))
+    # imported lazily, selecting a backend is expensive
+    import keyring
+
+    backend = keyring.get_keyring()
+    bulk_fetch = getattr(backend, "get_passwords", None)
+    if bulk_fetch is not None:
+        vlog("fetching %d credentials in bulk from %s", len(pairs), backend)
+        with span("get_passwords", count=len(pairs)):
+            return list(bulk_fetch(pairs))
+    if max_workers == 1 or len(pairs) == 1:
+        return [get_password(pair) for pair in pairs]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(pairs))) as pool:
+        return list(pool.map(get_password, pairs))
+
+
+def get_source(src):
+    """Determine where the secret of a key is stored"""
+    source = src.get("source", "keyring")
+    if source not in SOURCES:
+        raise KeycmdError(
+            f"INVALID source {source!r} for credential {src['credential']},"
+            f" expected one of {', '.join(SOURCES)}"
+        )
+    return source
+
+
+def get_pair(src):
+    """
+    Identify the secret of a key in the dict returned by resolve_passwords,
+    secrets from the vault are keyed by ("vault", credential, username)
+    """
+    pair = (src["credential"], src["username"])
+    if get_source(src) == "vault":
+        return ("vault", *pair)
+    return pair
+
+
+def get_pairs(conf, source="keyring"):
+    """
+    List the unique (credential, username) pairs referenced by the keys
+    that are stored in the given source
+    """
+    return list(
+        dict.fromkeys(
+            (src["credential"], src["username"])
+            for src in conf["keys"].values()
+            if get_source(src) == source
+        )
+    )
+
+
+def resolve_vault_passwords(conf, cache=None):
+    """
+    Fetch the passwords of the keys stored in the vault, decrypting
+    it at most once, see resolve_passwords
+    """
+    keys = [("vault", *pair) for pair in get_pairs(conf, source="vault")]
+    passwords = dict.fromkeys(keys)
+    if cache:
+        passwords.update((key, cache[key]) for key in keys if key in cache)
+    missing = [key for key, password in passwords.items() if password is None]
+    if missing:
+        fetched = vault.get_passwords([key[1:] for key in missing], conf=conf)
+        passwords.update(zip(missing, fetched))
+    return passwords
+
+
+def resolve_passwords(conf, cache=None, refresh=False):
+    """
+    Fetch the password of every unique (credential, username) pair
+    referenced by the configured keys, returning a dict keyed by pair
+    (see get_pair). Passwords found in the cache dict are reused, fetched
+    passwords are added to it. A running agent and the session keyring (if
+    enabled, unless refresh is set) are asked next, the keyring is used for
+    anything they do not know about. Keys with source = "vault" are read
+    from the vault instead.
+    """
+    pairs = get_pairs(conf)
+    passwords = dict.fromkeys(pairs)
+    if cache:
+        passwords.update((pair, cache[pair]) for pair in pairs if pair in cache)
+        pairs = [pair for pair in pairs if passwords[pair] is None]
+    if pairs:
+        with span("agent", count=len(pairs)):
+            passwords.update(zip(pairs, agent.get_passwords(pairs) or []))
+    missing = [pair for pair, password in passwords.items() if password is None]
+    ttl = keyctl.get_ttl(conf)
+    if missing and ttl and not refresh:
+        passwords.update(zip(missing, keyctl.get_passwords(missing)))
+        missing = [pair for pair in missing if passwords[pair] is None]
+    if missing:
+        fetched = get_passwords(
+            missing, max_workers=get_max_workers(conf), chain=backends.get_chain(conf)
         )
-        expose(env, key, *key_data[key])
-        vlog(
-            f"exposing credential {src['credential']}"
-            f" with user {src['username']}"
-            f" as environment variable {key}"
-            f" (b64: {apply_b64}, format: {format_string})"
+        passwords.update(zip(missing, fetched))
+        if ttl:
+            keyctl.set_passwords(
+                {pair: pw for pair, pw in zip(missing, fetched) if pw is not None}, ttl
+            )
+    passwords.update(resolve_vault_passwords(conf, cache=cache))
+    if cache is not None:
+        cache.update((pair, pw) for pair, pw in passwords.items() if pw is not None)
+    return passwords
+
+
+async def get_password_async(pair, semaphore, timeout=None, chain=None):
+    """
+    Look up the password of a (credential, username) pair in a worker
+    thread, waiting at most timeout seconds. Concurrent lookups of the same
+    pair on the same event loop share a single backend call, which keeps
+    running if one of the callers times out or is cancelled.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    inflight = _inflight.setdefault(loop, {})
+    task = inflight.get(pair)
+    if task is None:
+
+        async def fetch():
+            async with semaphore:
+                return await loop.run_in_executor(None, get_password, pair, chain)
+
+        task = loop.create_task(fetch())
+        inflight[pair] = task
+        task.add_done_callback(
+            lambda task: inflight.pop(pair) if inflight.get(pair) is task else None
         )
+    else:
+        vlog("joining lookup of credential %s with user %s", *pair)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except asyncio.TimeoutError as err:
+        raise KeycmdError(
+            f"TIMEOUT looking up credential {pair[0]} with user {pair[1]}"
+            f" after {timeout} seconds"
+        ) from err
+
+
+async def resolve_passwords_async(conf, cache=None, timeout=None):
+    """
+    Like resolve_passwords, without blocking the event loop. Keyring
+    lookups run in the default executor, at most max_workers at a time,
+    and every lookup may take at most timeout seconds.
+    """
+    import asyncio
 
-    for alias, src in conf.get("aliases", {}).items():
-        key = key_data.get(src["key"])
-        if key is None:
-            error(f"MISSING alias key {src['key']}")
-        # re-use base data but replace apply_b64 and format_string
-        credential, username, password, _, _ = key
-        apply_b64 = src.get("b64", False)
-        format_string = src.get("format")
-        expose(env, alias, credential, username, password, apply_b64, format_string)
-        vlog(
-            f"aliasing {src['key']}"
-            f" as environment variable {alias}"
-            f" (b64: {apply_b64}, format: {format_string})"
+    loop = asyncio.get_running_loop()
+    pairs = get_pairs(conf)
+    passwords = dict.fromkeys(pairs)
+    if cache:
+        passwords.update((pair, cache[pair]) for pair in pairs if pair in cache)
+        pairs = [pair for pair in pairs if passwords[pair] is None]
+    if pairs:
+        from_agent = await loop.run_in_executor(None, agent.get_passwords, pairs)
+        passwords.update(zip(pairs, from_agent or []))
+    missing = [pair for pair, password in passwords.items() if password is None]
+    ttl = keyctl.get_ttl(conf)
+    if missing and ttl:
+        passwords.update(zip(missing, keyctl.get_passwords(missing)))
+        missing = [pair for pair in missing if passwords[pair] is None]
+    if missing:
+        semaphore = asyncio.Semaphore(get_max_workers(conf))
+        chain = backends.get_chain(conf)
+        fetched = await asyncio.gather(
+            *(get_password_async(pair, semaphore, timeout, chain) for pair in missing)
         )
+        passwords.update(zip(missing, fetched))
+        if ttl:
+            keyctl.set_passwords(
+                {pair: pw for pair, pw in zip(missing, fetched) if pw is not None}, ttl
+            )
+    passwords.update(
+        await loop.run_in_executor(None, resolve_vault_passwords, conf, cache)
+    )
+    if cache is not None:
+        cache.update((pair, pw) for pair, pw in passwords.items() if pw is not None)
+    return passwords
+
+
+async def get_secrets_async(conf, cache=None, timeout=None):
+    """
+    Like get_secrets, without blocking the event loop, see
+    resolve_passwords_async
+    """
+    passwords = await resolve_passwords_async(conf, cache=cache, timeout=timeout)
+    return expose_secrets(conf, passwords)
+
+
+async def get_env_async(conf, cache=None, timeout=None):
+    """Like get_env, without blocking the event loop"""
+    env = environ.copy()
+    env.update(await get_secrets_async(conf, cache=cache, timeout=timeout))
+    return env
+
+
+def get_env(conf, cache=None, refresh=False):
+    """Load credentials from the OS keyring according to user configuration"""
+    env = environ.copy()
+    env.update(get_secrets(conf, cache=cache, refresh=refresh))
+    return env
+
+
+def get_secrets(conf, cache=None, refresh=False):
+    """
+    Load credentials from the OS keyring according to user configuration,
+    returning only the environment variables for keys and aliases
+    """
+    with span("resolve_passwords"):
+        passwords = resolve_passwords(conf, cache=cache, refresh=refresh)
+    return expose_secrets(conf, passwords)
+
+
+def expose_secrets(conf, passwords):
+    """
+    Build the environment variables for keys and aliases from the resolved
+    passwords, as returned by resolve_passwords. Aliases of keys transform
+    the password of the key, aliases of aliases transform the value of the
+    alias they refer to.
+    """
+    env = {}
+    with span("expose"):
+        keys = conf["keys"]
+        aliases = conf.get("aliases", {})
+        # (pair, source value, format, b64) -> transformed value
+        transforms = {}
+        for key, src in keys.items():
+            password = passwords[get_pair(src)]
+            if password is None:
+                raise KeycmdError(
+                    f"MISSING credential {src['credential']}"
+                    f" with user {src['username']}"
+                    f" as it does not exist"
+                )
+            add_secret(password)
+            apply_b64 = src.get("b64", False)
+            format_string = src.get("format")
+            as_file = src.get("file", False)
+            value = transform(src, password, format_string, apply_b64, transforms)
+            env[key] = files.create(key, value) if as_file else value
+            vlog(
+                "exposing credential %s with user %s as environment variable %s"
+                " (b64: %s, format: %s, file: %s)",
+                src["credential"],
+                src["username"],
+                key,
+                apply_b64,
+                format_string,
+                as_file,
+                event="key_exposed",
+                key=key,
+                credential=src["credential"],
+                username=src["username"],
+            )
+
+        # alias -> (src of the key at the root, value)
+        values = {}
+        for alias in sort_aliases(keys, aliases):
+            src = aliases[alias]
+            if src["key"] in keys:
+                # aliases of keys transform the password, not the key's value
+                key_src = keys[src["key"]]
+                password = passwords[get_pair(key_src)]
+            else:
+                key_src, password = values[src["key"]]
+            apply_b64 = src.get("b64", False)
+            format_string = src.get("format")
+            value = transform(key_src, password, format_string, apply_b64, transforms)
+            values[alias] = (key_src, value)
+
+        for alias, src in aliases.items():
+            _, value = values[alias]
+            as_file = src.get("file", False)
+            env[alias] = files.create(alias, value) if as_file else value
+            vlog(
+                "aliasing %s as environment variable %s (b64: %s, format: %s,"
+                " file: %s)",
+                src["key"],
+                alias,
+                src.get("b64", False),
+                src.get("format"),
+                as_file,
+                event="alias_exposed",
+                alias=alias,
+                key=src["key"],
+            )
     return env
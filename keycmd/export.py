@@ -0,0 +1,65 @@
+import json
+import re
+
+from .logs import KeycmdError
+
+FORMATS = ("sh", "fish", "powershell", "json", "dotenv", "nul")
+# variable names that can safely be used in all shells
+NAME_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def quote_sh(value):
+    """Quote a value for posix shells, nothing is special inside single quotes"""
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def quote_fish(value):
+    """Quote a value for fish, where \\ and ' are escaped inside single quotes"""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def quote_powershell(value):
+    """
+    Quote a value for powershell, where single quotes (including the
+    typographic variants powershell also accepts) are escaped by doubling them
+    """
+    for quote in "'\u2018\u2019\u201a\u201b":
+        value = value.replace(quote, quote * 2)
+    return "'" + value + "'"
+
+
+def quote_dotenv(value):
+    """Quote a value for dotenv files, where \\ and ' are escaped in single quotes"""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def format_env(env, names, fmt):
+    """
+    Format the given variables from env so they can be evaluated by a shell
+    or read by another program
+    """
+    if fmt not in FORMATS:
+        raise KeycmdError(
+            f"unknown export format {fmt}, expected one of {', '.join(FORMATS)}"
+        )
+    variables = {name: env[name] for name in names}
+    if fmt == "json":
+        return json.dumps(variables, indent=2) + "\n"
+    if fmt == "nul":
+        return "".join(f"{name}={value}\0" for name, value in variables.items())
+    for name in variables:
+        if not NAME_PATTERN.fullmatch(name):
+            raise KeycmdError(
+                f"cannot export {name} as {fmt}, it is not a valid variable name"
+            )
+    if fmt == "sh":
+        lines = [f"export {name}={quote_sh(v)}" for name, v in variables.items()]
+    elif fmt == "fish":
+        lines = [f"set -gx {name} {quote_fish(v)}" for name, v in variables.items()]
+    elif fmt == "powershell":
+        lines = [
+            f"$env:{name} = {quote_powershell(v)}" for name, v in variables.items()
+        ]
+    else:
+        lines = [f"{name}={quote_dotenv(v)}" for name, v in variables.items()]
+    return "".join(f"{line}\n" for line in lines)
@@ -0,0 +1,105 @@
+import os
+import sys
+
+from .logs import KeycmdError, vlog
+
+# (name, contents) -> file descriptor of the secret files exposed so far
+_files = {}
+
+
+def get_fd_path(fd):
+    """Construct the path a child process can open a file descriptor with"""
+    if sys.platform.startswith("linux"):
+        return f"/proc/self/fd/{fd}"
+    return f"/dev/fd/{fd}"
+
+
+def create_memfd(name, data):
+    """Write data to an anonymous, sealed file that only lives in memory"""
+    import fcntl
+
+    fd = os.memfd_create(f"keycmd:{name}", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+        # the file can't be changed anymore, by the child process or anyone else
+        fcntl.fcntl(
+            fd,
+            fcntl.F_ADD_SEALS,
+            fcntl.F_SEAL_SHRINK
+            | fcntl.F_SEAL_GROW
+            | fcntl.F_SEAL_WRITE
+            | fcntl.F_SEAL_SEAL,
+        )
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+def create_pipe(name, data):
+    """
+    Write data to a pipe, returning the end to read it from. The data must
+    fit in the buffer of the pipe, as nothing is left to write it once the
+    process is replaced by the command.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        os.set_blocking(write_fd, False)
+        try:
+            written = os.write(write_fd, data) if data else 0
+        except BlockingIOError:
+            written = 0
+        if written < len(data):
+            raise KeycmdError(
+                f"secret {name} is too large to pass in a pipe"
+                f" ({len(data)} bytes), memfd_create is not available"
+            )
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    return read_fd
+
+
+def create(name, value):
+    """
+    Expose a secret as a file that is never written to disk, returning the
+    path child processes can read it from. The same secret is only
+    exposed in memory once.
+    """
+    if os.name == "nt":
+        raise KeycmdError(f"secret files are not supported on Windows ({name})")
+    data = value.encode("utf-8")
+    fd = _files.get((name, data))
+    if fd is not None:
+        return get_fd_path(fd)
+    if hasattr(os, "memfd_create"):
+        fd = create_memfd(name, data)
+        item = (name, data)
+    else:
+        vlog("memfd_create is not available, passing %s in a pipe", name)
+        fd = create_pipe(name, data)
+        # a pipe can only be read once, so it is never re-used
+        item = (name, fd)
+    # inherited by the command, both when it replaces this process and
+    # when it is started as a subprocess (see get_fds)
+    os.set_inheritable(fd, True)
+    _files[item] = fd
+    return get_fd_path(fd)
+
+
+def get_fds():
+    """List the file descriptors of the secret files, to pass on to commands"""
+    return tuple(_files.values())
+
+
+def prune(env):
+    """Close the secret files that are no longer exposed in env"""
+    paths = set(env.values())
+    for item, fd in list(_files.items()):
+        if get_fd_path(fd) not in paths:
+            os.close(fd)
+            del _files[item]
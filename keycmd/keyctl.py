@@ -0,0 +1,130 @@
+import hashlib
+import platform
+import sys
+
+from .logs import KeycmdError, span, vlog
+
+# syscall numbers of add_key and keyctl, per architecture
+SYSCALLS = {
+    "x86_64": (248, 250),
+    "aarch64": (217, 219),
+}
+IS_SUPPORTED = sys.platform.startswith("linux") and platform.machine() in SYSCALLS
+KEY_SPEC_SESSION_KEYRING = -3
+KEYCTL_SEARCH = 10
+KEYCTL_READ = 11
+KEYCTL_SET_TIMEOUT = 15
+KEYCTL_INVALIDATE = 21
+
+_libc = None
+
+
+def get_ttl(conf):
+    """
+    Read the number of seconds secrets are cached in the session keyring
+    from the settings, returns 0 if the cache is disabled or not supported
+    """
+    ttl = conf.get("settings", {}).get("session_cache", 0)
+    if not isinstance(ttl, int) or isinstance(ttl, bool) or ttl < 0:
+        raise KeycmdError(
+            f"INVALID setting session_cache {ttl!r}, expected a number of seconds"
+        )
+    if ttl and not IS_SUPPORTED:
+        vlog("the session keyring is not supported on this platform")
+        return 0
+    return ttl
+
+
+def syscall(number, *args):
+    """Make a raw system call, returns None if it failed"""
+    import ctypes
+
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.syscall.restype = ctypes.c_long
+    args = [ctypes.c_long(arg) if isinstance(arg, int) else arg for arg in args]
+    result = _libc.syscall(ctypes.c_long(number), *args)
+    if result < 0:
+        return None
+    return result
+
+
+def describe(pair):
+    """
+    Name the key of a (credential, username) pair, hashed so the names of
+    credentials don't show up in /proc/keys
+    """
+    digest = hashlib.sha256("\0".join(pair).encode("utf-8")).hexdigest()
+    return f"keycmd:{digest[:32]}".encode("ascii")
+
+
+def get_password(pair):
+    """Read a password from the session keyring, returns None if it isn't there"""
+    import ctypes
+
+    _, keyctl = SYSCALLS[platform.machine()]
+    key = syscall(
+        keyctl, KEYCTL_SEARCH, KEY_SPEC_SESSION_KEYRING, b"user", describe(pair), 0
+    )
+    if key is None:
+        return None
+    size = syscall(keyctl, KEYCTL_READ, key, None, 0)
+    while size is not None:
+        buffer = ctypes.create_string_buffer(size)
+        # the size of the payload, which may have grown in the meantime
+        read = syscall(keyctl, KEYCTL_READ, key, buffer, size)
+        if read is not None and read <= size:
+            return buffer.raw[:read].decode("utf-8")
+        size = read
+    return None
+
+
+def set_password(pair, password, ttl):
+    """
+    Store a password in the session keyring, the kernel removes it after
+    ttl seconds
+    """
+    add_key, keyctl = SYSCALLS[platform.machine()]
+    payload = password.encode("utf-8")
+    key = syscall(
+        add_key,
+        b"user",
+        describe(pair),
+        payload,
+        len(payload),
+        KEY_SPEC_SESSION_KEYRING,
+    )
+    if key is None:
+        return False
+    if syscall(keyctl, KEYCTL_SET_TIMEOUT, key, ttl) is None:
+        # never leave a secret behind without a timeout
+        syscall(keyctl, KEYCTL_INVALIDATE, key)
+        return False
+    return True
+
+
+def get_passwords(pairs):
+    """
+    Read the passwords of a list of (credential, username) pairs from the
+    session keyring, in the same order as the pairs, None if missing
+    """
+    with span("keyctl", count=len(pairs)):
+        passwords = [get_password(pair) for pair in pairs]
+    vlog(
+        "found %d of %d credentials in the session keyring",
+        sum(password is not None for password in passwords),
+        len(pairs),
+    )
+    return passwords
+
+
+def set_passwords(passwords, ttl):
+    """
+    Store a dict of passwords keyed by (credential, username) pairs in the
+    session keyring
+    """
+    for pair, password in passwords.items():
+        if not set_password(pair, password, ttl):
+            vlog("failed to cache credentials in the session keyring")
+            return
@@ -1,6 +1,47 @@
+import os
 import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+# field names whose values are never written to the log sink
+REDACTED_FIELDS = frozenset({"password", "secret", "value"})
+REDACTED = "***"
 
 _verbose = False
+# the structured log sink, see set_log_sink
+_sink = None
+_sink_lock = threading.Lock()
+# secret values that are redacted from everything written to the log sink
+_secrets = set()
+_timings = False
+_trace_path = None
+_registered = False
+_spans = []
+# approximates the start of the process, since this module is imported first
+_started = time.perf_counter()
+
+
+class KeycmdError(Exception):
+    """Raised when secrets can't be resolved due to configuration or keyring issues"""
+
+
+class Pretty:
+    """Pretty-prints an object, but only when the message is actually logged"""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        from pprint import pformat
+
+        return pformat(self.obj)
 
 
 def set_verbose(verbose=True):
@@ -8,23 +49,217 @@ def set_verbose(verbose=True):
     _verbose = verbose
 
 
-def log(msg, err=False):
-    msg = f"keycmd: {msg}"
-    if err:
-        print(msg, file=sys.stderr)
-    else:
-        print(msg)
+def is_verbose():
+    return _verbose
+
+
+def is_logging():
+    """Whether verbose messages are printed or written to the log sink"""
+    return _verbose or _sink is not None
+
+
+def set_log_sink(spec):
+    """
+    Write all log messages and events as JSON lines, spec is json:path
+    (json:- for stderr). Secret values are always redacted.
+    """
+    global _sink
+    fmt, _, path = spec.partition(":")
+    if fmt != "json" or not path:
+        raise KeycmdError(f"INVALID log sink {spec}, expected json:path")
+    if path == "-":
+        _sink = sys.stderr
+        return
+    try:
+        _sink = open(path, "a", encoding="utf-8", buffering=1)
+    except OSError as err:
+        raise KeycmdError(f"failed to open log sink {path}: {err}") from err
+
+
+def close_log_sink():
+    global _sink
+    if _sink is not None and _sink is not sys.stderr:
+        _sink.close()
+    _sink = None
+    _secrets.clear()
+
+
+def add_secret(value):
+    """Register a secret value, so it is redacted from the log sink"""
+    if _sink is not None and value:
+        _secrets.add(value)
+
+
+def redact(value):
+    if isinstance(value, str):
+        for secret in _secrets:
+            value = value.replace(secret, REDACTED)
+    return value
+
+
+def format_msg(msg, args):
+    """Build a message lazily, from a callable or a %-style format string"""
+    if callable(msg):
+        return msg()
+    if args:
+        return msg % args
+    return str(msg)
+
+
+def write_event(level, msg, event, fields):
+    import json
+
+    record = {"ts": time.time(), "level": LEVEL_NAMES[level]}
+    if event is not None:
+        record["event"] = event
+    record["msg"] = redact(msg)
+    for name, value in fields.items():
+        record[name] = REDACTED if name in REDACTED_FIELDS else redact(value)
+    line = json.dumps(record, default=str)
+    with _sink_lock:
+        _sink.write(line + "\n")
+
+
+def emit(level, msg, args, show, event=None, fields=None, err=False):
+    """Print a message if show is set, and write it to the log sink"""
+    if not show and _sink is None:
+        return
+    msg = format_msg(msg, args)
+    if show:
+        # a single write, so messages of concurrent threads don't interleave
+        (sys.stderr if err else sys.stdout).write(f"keycmd: {msg}\n")
+    if _sink is not None:
+        write_event(level, msg, event, fields or {})
+
 
+def log(msg, *args, err=False):
+    emit(INFO, msg, args, True, err=err)
 
-def vlog(msg):
-    if _verbose:
-        print(f"keycmd: {msg}")
+
+def vlog(msg, *args, event=None, **fields):
+    """
+    Log a message in verbose mode. Messages are built lazily, msg can be a
+    %-style format string for args or a callable that returns the message.
+    With event, the message is recorded in the log sink as a structured
+    event with the given fields.
+    """
+    if _verbose or _sink is not None:
+        emit(DEBUG, msg, args, _verbose, event, fields)
 
 
 def error(msg):
-    log(f"error: {msg}", err=True)
+    emit(ERROR, "error: %s", (msg,), True, err=True)
     sys.exit(1)
 
 
-def vwarn(msg):
-    vlog(f"warning: {msg}")
+def vwarn(msg, *args):
+    if _verbose or _sink is not None:
+        emit(WARNING, lambda: f"warning: {format_msg(msg, args)}", (), _verbose)
+
+
+class Span:
+    """Records the duration of a phase when timings are enabled"""
+
+    __slots__ = ("args", "name", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_span(self.name, self.start, time.perf_counter(), **self.args)
+
+
+class NullSpan:
+    """Stand-in for Span that does nothing when timings are disabled"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_span = NullSpan()
+
+
+def set_timings(summary=True, trace_path=None):
+    """
+    Enable recording of timings, which are reported on exit as a summary
+    table on stderr and/or as a Chrome trace-event JSON file
+    """
+    global _timings, _trace_path, _registered
+    if not _registered:
+        import atexit
+
+        atexit.register(report_timings)
+        _registered = True
+    _timings = summary or _timings
+    _trace_path = trace_path or _trace_path
+    add_span("imports", _started, time.perf_counter())
+
+
+def is_timing():
+    return _timings or _trace_path is not None
+
+
+def span(name, **args):
+    """Measure the duration of a with-block as a span with the given name"""
+    if _timings or _trace_path is not None:
+        return Span(name, args)
+    return _null_span
+
+
+def add_span(name, start, end, **args):
+    """Record a span that has already ended"""
+    if _timings or _trace_path is not None:
+        _spans.append((name, start, end, threading.get_ident(), args))
+
+
+def report_timings():
+    """Print the timings summary and write the trace file, once"""
+    global _timings, _trace_path
+    spans = sorted(_spans, key=lambda s: s[1])
+    _spans.clear()
+    if _timings:
+        totals = {}
+        for name, start, end, _, _ in spans:
+            count, total = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, total + end - start)
+        width = max([len(name) for name in totals] + [5])
+        print(
+            f"keycmd: {'phase':<{width}} {'count':>6} {'total ms':>10}", file=sys.stderr
+        )
+        for name, (count, total) in totals.items():
+            print(
+                f"keycmd: {name:<{width}} {count:>6} {total * 1000:>10.2f}",
+                file=sys.stderr,
+            )
+        wall = (time.perf_counter() - _started) * 1000
+        print(f"keycmd: {'wall':<{width}} {'':>6} {wall:>10.2f}", file=sys.stderr)
+    if _trace_path is not None:
+        import json
+
+        pid = os.getpid()
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (start - _started) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            }
+            for name, start, end, tid, args in spans
+        ]
+        with open(_trace_path, "w", encoding="utf-8") as fh:
+            json.dump({"traceEvents": events}, fh)
+    _timings = False
+    _trace_path = None
@@ -0,0 +1,168 @@
+import threading
+from queue import SimpleQueue
+
+from . import agent, backends, creds, keyctl
+from .conf import get_selection
+from .logs import KeycmdError, span, vlog
+
+# settings that change how credentials are looked up, prefetched passwords
+# are discarded if any of them changes
+LOOKUP_SETTINGS = ("backends", "backend_timeout", "hedge_ms", "session_cache")
+
+
+def get_lookup_settings(conf):
+    """Summarize the settings that change how credentials are looked up"""
+    settings = conf.get("settings", {})
+    return tuple(repr(settings.get(name)) for name in LOOKUP_SETTINGS)
+
+
+def fetch_password(pair, chain, ttl, refresh=False):
+    """
+    Look up a single password like resolve_passwords does: in a running
+    agent, the session keyring and then the keyring
+    """
+    passwords = agent.get_passwords([pair])
+    password = passwords[0] if passwords else None
+    if password is None and ttl and not refresh:
+        password = keyctl.get_password(pair)
+    if password is None:
+        password = creds.get_password(pair, chain=chain)
+        if password is not None and ttl:
+            keyctl.set_password(pair, password, ttl)
+    return password
+
+
+class Prefetcher:
+    """
+    Looks up credentials in the background while the configuration is
+    still being loaded. Every parsed layer is passed to add_layer, which
+    starts looking up the credentials of the keys known so far, and
+    cancels the lookups of keys that were overridden since. Only the keys
+    selected by the given profiles and names are looked up. collect waits
+    for the lookups that are still relevant to the final configuration.
+    """
+
+    def __init__(self, refresh=False, profiles=(), only=()):
+        self.refresh = refresh
+        self.profiles = profiles
+        self.only = only
+        # (pair, lookup settings) -> Future
+        self.futures = {}
+        self.tasks = SimpleQueue()
+        self.workers = 0
+        self.settings = None
+        self.chain = None
+        self.ttl = 0
+        self.max_workers = creds.DEFAULT_MAX_WORKERS
+        self.disabled = False
+
+    def add_layer(self, conf):
+        """Start looking up the credentials of the keys configured so far"""
+        if self.disabled:
+            return
+        settings = get_lookup_settings(conf)
+        if settings != self.settings:
+            try:
+                self.chain = backends.get_chain(conf)
+                self.ttl = keyctl.get_ttl(conf)
+                self.max_workers = creds.get_max_workers(conf)
+            except KeycmdError as err:
+                # reported once the configuration is used
+                vlog("not prefetching credentials: %s", err)
+                self.disabled = True
+                self.cancel()
+                return
+            if self.settings is not None:
+                vlog("lookup settings changed, discarding prefetched credentials")
+            self.settings = settings
+
+        try:
+            selected = get_selection(conf, profiles=self.profiles, only=self.only)
+        except (KeycmdError, KeyError, TypeError, AttributeError):
+            # e.g. the profile is defined in a later layer
+            self.cancel()
+            return
+        pairs = set()
+        for name, src in conf.get("keys", {}).items():
+            if selected is not None and name not in selected:
+                continue
+            try:
+                # the vault may prompt for a passphrase, it is not prefetched
+                if creds.get_source(src) == "keyring":
+                    pairs.add(creds.get_pair(src))
+            except (KeycmdError, KeyError, TypeError, AttributeError):
+                # incomplete keys may be completed by a later layer
+                continue
+        self.cancel(keep={(pair, settings) for pair in pairs})
+        for pair in pairs:
+            future = self.futures.get((pair, settings))
+            if future is None or future.cancelled():
+                self.submit(pair, settings)
+
+    def submit(self, pair, settings):
+        """Queue the lookup of a password, starting a worker if allowed"""
+        # imported lazily, it also loads logging
+        from concurrent.futures import Future
+
+        future = Future()
+        self.futures[pair, settings] = future
+        self.tasks.put((future, pair, self.chain, self.ttl))
+        if self.workers < self.max_workers:
+            self.workers += 1
+            # daemon threads, so a lookup that hangs can't keep the process alive
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        """Perform queued lookups until collect is called"""
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            future, pair, chain, ttl = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fetch_password(pair, chain, ttl, self.refresh))
+            except BaseException as err:
+                future.set_exception(err)
+
+    def cancel(self, keep=()):
+        """
+        Cancel all lookups, except those in keep. Lookups that already
+        started run to completion, but their results are ignored.
+        """
+        for item, future in list(self.futures.items()):
+            if item not in keep:
+                future.cancel()
+                del self.futures[item]
+
+    def collect(self, conf):
+        """
+        Wait for the lookups of the credentials in the final configuration,
+        cancelling any others. Returns the passwords that were found as a
+        dict keyed by pair, to be used as the cache of resolve_passwords.
+        """
+        passwords = {}
+        if not self.disabled:
+            settings = get_lookup_settings(conf)
+            try:
+                pairs = creds.get_pairs(conf)
+            except (KeycmdError, KeyError, TypeError, AttributeError):
+                pairs = []
+            self.cancel(keep={(pair, settings) for pair in pairs})
+            with span("prefetch_wait", count=len(self.futures)):
+                for (pair, _), future in self.futures.items():
+                    try:
+                        password = future.result()
+                    except Exception as err:
+                        # looked up again, so the error is reported as usual
+                        vlog("prefetching failed: %s", err)
+                        continue
+                    if password is not None:
+                        passwords[pair] = password
+            vlog("prefetched %d credentials", len(passwords))
+        self.futures.clear()
+        for _ in range(self.workers):
+            self.tasks.put(None)
+        self.workers = 0
+        return passwords
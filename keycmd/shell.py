@@ -1,35 +1,110 @@
 import os
+import sys
+import threading
+import time
 from pathlib import Path
-from pprint import pformat
-from subprocess import run
 from sys import exit
 
-from shellingham import ShellDetectionFailure, detect_shell
-
-from .logs import vlog, vwarn
+from . import files
+from .logs import Pretty, add_span, log, report_timings, span, vlog, vwarn
 
 USE_SUBPROCESS = False  # exposed for testing
 IS_WINDOWS = os.name == "nt"
 IS_POSIX = os.name == "posix"
+SHELL_CACHE_FILE = "shells.json"
+SHELL_CACHE_SIZE = 64
+# characters that (may) have a special meaning in posix shells, cmd or powershell
+SHELL_CHARS = frozenset("$`|&;<>()[]{}*?~!#%^'\"\\\n")
+# shell detection running in the background, see start_detection
+_detection = None
 
 
 def exec(args, env):
     if USE_SUBPROCESS or IS_WINDOWS:
         # windows does not support process replacement
         # as well as posix systems do
-        p = run(args, shell=False, env=env)
+        from subprocess import run
+
+        with span("exec", command=args[0]):
+            p = run(args, shell=False, env=env, pass_fds=files.get_fds())
         exit(p.returncode)
+    # the process is replaced, so report timings now
+    now = time.perf_counter()
+    add_span("exec", now, now, command=args[0])
+    report_timings()
     # i know this looks like a bug
     # but it's a mandatory convention
     # to pass the process name as the first argument
     os.execvpe(args[0], args, env)
 
 
-def get_shell():
+def get_shell_key():
+    """
+    Identify the context in which the shell was detected, by the parent
+    process (and its start time, where available), session and $SHELL
+    """
+    ppid = os.getppid()
+    key = [str(ppid), os.environ.get("SHELL", "")]
+    if IS_POSIX:
+        key.append(str(os.getsid(0)))
+    try:
+        with open(f"/proc/{ppid}/stat", "rb") as fh:
+            # guard against pid reuse with the start time of the process
+            key.append(fh.read().rsplit(b")", 1)[1].split()[19].decode())
+    except (OSError, IndexError):
+        pass
+    return ":".join(key)
+
+
+def read_shell_cache(key):
+    """Read a previously detected shell from the cache"""
+    import json
+
+    from . import cache
+
+    try:
+        with (cache.get_cache_dir() / SHELL_CACHE_FILE).open("rb") as fh:
+            shell_name, shell_path = json.load(fh)[key]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if not os.path.exists(shell_path):
+        return None
+    return shell_name, shell_path
+
+
+def write_shell_cache(key, shell_name, shell_path):
+    """Store a detected shell in the cache, keeping only the most recent entries"""
+    import json
+
+    from . import cache
+
+    path = cache.get_cache_dir() / SHELL_CACHE_FILE
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        with path.open("rb") as fh:
+            shells = json.load(fh)
+    except (OSError, ValueError):
+        shells = {}
+    shells.pop(key, None)
+    shells[key] = [shell_name, shell_path]
+    shells = dict(list(shells.items())[-SHELL_CACHE_SIZE:])
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_path.write_text(json.dumps(shells), encoding="utf-8")
+        os.replace(tmp_path, path)
+    except OSError as err:
+        vlog("failed to write cache %s: %s", path, err)
+        tmp_path.unlink(missing_ok=True)
+
+
+def detect_parent_shell():
     """Use shellingham to detect the shell that invoked
     this Python process"""
+    from shellingham import ShellDetectionFailure, detect_shell
+
     try:
-        shell_name, shell_path = detect_shell(os.getpid())
+        with span("detect_shell"):
+            shell_name, shell_path = detect_shell(os.getpid())
     except ShellDetectionFailure as err:
         vwarn("failed to detect parent process shell, falling back to system default")
         if IS_POSIX:
@@ -39,26 +114,217 @@ def get_shell():
         else:
             raise NotImplementedError(f"os {os.name} support not available") from err
         shell_name = Path(shell_path).name.lower()
-    vlog(f"detected shell: {shell_path}")
+    vlog("detected shell: %s", shell_path, event="shell_detected", shell=shell_path)
     return shell_name, shell_path
 
 
-def run_shell(env=None):
+def start_detection(use_cache=False):
+    """
+    Start detecting the shell that invoked this Python process in the
+    background, the next call to get_shell waits for the result. Does
+    nothing if a detection was started already.
+    """
+    global _detection
+    if _detection is not None and _detection[0] == use_cache:
+        return
+    result = []
+
+    def detect():
+        try:
+            result.append(find_shell(use_cache=use_cache))
+        except BaseException as err:
+            result.append(err)
+
+    thread = threading.Thread(target=detect, daemon=True)
+    thread.start()
+    _detection = (use_cache, thread, result)
+
+
+def get_shell(shell=None, use_cache=False):
+    """
+    Determine the shell to run commands with. If no shell is given explicitly,
+    the shell that invoked this Python process is detected, or the result of
+    start_detection is used. With use_cache, detected shells are remembered
+    per parent process, session and $SHELL.
+    """
+    global _detection
+    if shell:
+        shell_path = shell
+        shell_name = Path(shell_path).name.lower()
+        if shell_name.endswith(".exe"):
+            shell_name = shell_name[: -len(".exe")]
+        vlog(
+            "using configured shell: %s",
+            shell_path,
+            event="shell_detected",
+            shell=shell_path,
+        )
+        return shell_name, shell_path
+    if _detection is not None and _detection[0] == use_cache:
+        _, thread, result = _detection
+        _detection = None
+        thread.join()
+        if isinstance(result[0], BaseException):
+            raise result[0]
+        return result[0]
+    return find_shell(use_cache=use_cache)
+
+
+def find_shell(use_cache=False):
+    """
+    Detect the shell that invoked this Python process. With use_cache,
+    detected shells are remembered per parent process, session and $SHELL.
+    """
+    if not use_cache:
+        return detect_parent_shell()
+    key = get_shell_key()
+    cached = read_shell_cache(key)
+    if cached is not None:
+        vlog(
+            "using cached shell: %s",
+            cached[1],
+            event="shell_detected",
+            shell=cached[1],
+        )
+        return cached
+    shell_name, shell_path = detect_parent_shell()
+    write_shell_cache(key, shell_name, shell_path)
+    return shell_name, shell_path
+
+
+def run_shell(env=None, shell=None, use_cache=False):
     """Open an interactive shell for the user to interact
     with."""
-    shell_name, shell_path = get_shell()
-    vlog(f"spawning subshell: {shell_name}")
+    shell_name, shell_path = get_shell(shell=shell, use_cache=use_cache)
+    vlog("spawning subshell: %s", shell_name)
     exec([shell_path], env)
 
 
-def run_cmd(cmd, env=None):
-    """Run a one-off command in a shell."""
-    shell_name, shell_path = get_shell()
+def get_direct_args(cmd, env=None):
+    """
+    Split a command into arguments that can be executed directly, without
+    a shell. Returns None if the command requires features of a shell,
+    such as expansion, quoting, redirection or builtins. The program is
+    resolved against the PATH of env, as that is the environment the
+    command is meant to run in.
+    """
+    command = " ".join(cmd)
+    if SHELL_CHARS.intersection(command):
+        return None
+    args = command.split()
+    # variable assignments, e.g. FOO=bar cmd
+    if not args or "=" in args[0]:
+        return None
+    from shutil import which
+
+    path = (env if env is not None else os.environ).get("PATH")
+    program = which(args[0], path=path)
+    if program is None:
+        return None
+    # e.g. .bat and .cmd files can only be run by cmd.exe
+    if os.name == "nt" and not program.lower().endswith(".exe"):
+        return None
+    return [program, *args[1:]]
+
+
+def build_cmd(cmd, shell_name, shell_path):
+    """Construct the arguments to run a one-off command in a shell"""
     if shell_name == "cmd":
         opt = "/C"
     else:
         opt = "-c"
         cmd = [" ".join(cmd)]
-    full_command = [shell_path, opt, *cmd]
-    vlog(f"running command: {pformat(full_command)}")
-    exec(full_command, env)
+    return [shell_path, opt, *cmd]
+
+
+def get_cmd_args(cmd, env=None, shell=None, use_cache=False, direct=False):
+    """
+    Construct the arguments to run a one-off command with. With direct, the
+    command is executed without a shell, if it doesn't require any shell
+    features.
+    """
+    if direct:
+        args = get_direct_args(cmd, env=env)
+        if args is not None:
+            vlog("running command directly: %s", args)
+            return args
+        vlog("command requires a shell")
+    shell_name, shell_path = get_shell(shell=shell, use_cache=use_cache)
+    full_command = build_cmd(cmd, shell_name, shell_path)
+    vlog("running command: %s", Pretty(full_command))
+    return full_command
+
+
+def run_cmd(cmd, env=None, shell=None, use_cache=False, direct=False):
+    """
+    Run a one-off command in a shell. With direct, the command is executed
+    without a shell, if it doesn't require any shell features.
+    """
+    args = get_cmd_args(cmd, env=env, shell=shell, use_cache=use_cache, direct=direct)
+    exec(args, env)
+
+
+def pipe_lines(stream, out, prefix, lock):
+    """Copy lines from a stream to an output, prefixing every line"""
+    for line in iter(stream.readline, b""):
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        with lock:
+            out.write(prefix + line)
+            out.flush()
+    stream.close()
+
+
+def run_cmds(cmds, env=None, jobs=None, shell=None, use_cache=False, direct=False):
+    """
+    Run many one-off commands with the same environment, at most jobs at
+    a time (by default the number of cpus). Every line of output is prefixed
+    with the number of the command. Exits with the exit code of the first
+    command that failed, or 0.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    from concurrent.futures import ThreadPoolExecutor
+    from subprocess import PIPE, Popen
+
+    all_args = []
+    shell_name = shell_path = None
+    for cmd in cmds:
+        args = get_direct_args(cmd, env=env) if direct else None
+        if args is None:
+            if shell_path is None:
+                shell_name, shell_path = get_shell(shell=shell, use_cache=use_cache)
+            args = build_cmd(cmd, shell_name, shell_path)
+        all_args.append(args)
+
+    lock = threading.Lock()
+    width = len(str(len(all_args)))
+
+    def run_one(i, args):
+        prefix = f"[{i + 1:>{width}}] ".encode()
+        vlog("running command %d: %s", i + 1, args)
+        with span("exec", command=args[0]):
+            try:
+                p = Popen(
+                    args,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    env=env,
+                    pass_fds=files.get_fds(),
+                )
+            except OSError as err:
+                log(f"error: failed to run command {i + 1}: {err}", err=True)
+                return 1
+            stderr = threading.Thread(
+                target=pipe_lines, args=(p.stderr, sys.stderr.buffer, prefix, lock)
+            )
+            stderr.start()
+            pipe_lines(p.stdout, sys.stdout.buffer, prefix, lock)
+            stderr.join()
+            returncode = p.wait()
+        vlog("command %d exited with code %d", i + 1, returncode)
+        return returncode
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        returncodes = list(pool.map(run_one, range(len(all_args)), all_args))
+    exit(next((code for code in returncodes if code != 0), 0))
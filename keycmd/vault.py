@@ -0,0 +1,163 @@
+import base64
+import os
+from pathlib import Path
+
+from .logs import KeycmdError, span, vlog
+
+DEFAULT_PATH = "~/.keycmd-vault"
+VERSION = 1
+# scrypt cost parameters for new vaults, existing vaults store their own
+SCRYPT_N = 2**15
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def get_vault_path(conf=None):
+    """
+    Determine the location of the vault, from $KEYCMD_VAULT, the vault
+    setting or the default location in the home folder
+    """
+    path = os.environ.get("KEYCMD_VAULT")
+    if not path and conf is not None:
+        path = conf.get("settings", {}).get("vault")
+    return Path(path or DEFAULT_PATH).expanduser()
+
+
+def get_passphrase():
+    """
+    Read the passphrase from $KEYCMD_VAULT_PASSPHRASE, the key file in
+    $KEYCMD_VAULT_KEY_FILE, or prompt for it when running interactively
+    """
+    passphrase = os.environ.get("KEYCMD_VAULT_PASSPHRASE")
+    if passphrase:
+        return passphrase.encode("utf-8")
+    key_file = os.environ.get("KEYCMD_VAULT_KEY_FILE")
+    if key_file:
+        try:
+            return Path(key_file).expanduser().read_bytes().rstrip(b"\r\n")
+        except OSError as err:
+            raise KeycmdError(f"failed to read vault key file: {err}") from err
+    import sys
+
+    if sys.stdin.isatty():
+        from getpass import getpass
+
+        return getpass("keycmd vault passphrase: ").encode("utf-8")
+    raise KeycmdError(
+        "MISSING vault passphrase, set KEYCMD_VAULT_PASSPHRASE or KEYCMD_VAULT_KEY_FILE"
+    )
+
+
+def get_fernet(passphrase, header):
+    """Derive the encryption key from the passphrase"""
+    import hashlib
+
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError as err:
+        raise KeycmdError(
+            "the vault requires the cryptography package,"
+            " install it with: pip install keycmd[vault]"
+        ) from err
+
+    with span("vault_kdf"):
+        key = hashlib.scrypt(
+            passphrase,
+            salt=base64.b64decode(header["salt"]),
+            n=header["n"],
+            r=header["r"],
+            p=header["p"],
+            maxmem=2**27,
+            dklen=32,
+        )
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def unlock(path, passphrase=None):
+    """
+    Decrypt the vault at path, returning a tuple of its header and its
+    secrets as a {credential: {username: password}} dict. A vault that does
+    not exist is empty.
+    """
+    import json
+
+    if passphrase is None:
+        passphrase = get_passphrase()
+    try:
+        header = json.loads(path.read_bytes())
+    except FileNotFoundError:
+        vlog("vault %s does not exist yet", path)
+        header = {
+            "version": VERSION,
+            "salt": base64.b64encode(os.urandom(16)).decode("ascii"),
+            "n": SCRYPT_N,
+            "r": SCRYPT_R,
+            "p": SCRYPT_P,
+        }
+        return header, {}, get_fernet(passphrase, header)
+    except (OSError, ValueError) as err:
+        raise KeycmdError(f"failed to read vault {path}: {err}") from err
+    if header.get("version") != VERSION:
+        raise KeycmdError(f"unsupported vault version in {path}")
+
+    from cryptography.fernet import InvalidToken
+
+    fernet = get_fernet(passphrase, header)
+    with span("vault_decrypt", path=str(path)):
+        try:
+            secrets = json.loads(fernet.decrypt(header["data"].encode("ascii")))
+        except InvalidToken as err:
+            raise KeycmdError(
+                f"failed to unlock vault {path}, wrong passphrase?"
+            ) from err
+    return header, secrets, fernet
+
+
+def save(path, header, secrets, fernet):
+    """Encrypt and write the vault atomically, readable only by the user"""
+    import json
+
+    data = json.dumps(secrets).encode("utf-8")
+    header = {**header, "data": fernet.encrypt(data).decode("ascii")}
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(header, fh)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        tmp_path.unlink(missing_ok=True)
+        raise KeycmdError(f"failed to write vault {path}: {err}") from err
+
+
+def get_passwords(pairs, conf=None):
+    """
+    Look up the passwords for a list of (credential, username) pairs,
+    decrypting the vault once. Results are returned in the same order
+    as the pairs, None for missing credentials.
+    """
+    path = get_vault_path(conf)
+    vlog("unlocking vault %s for %d credentials", path, len(pairs))
+    _, secrets, _ = unlock(path)
+    return [secrets.get(credential, {}).get(username) for credential, username in pairs]
+
+
+def set_password(credential, username, password, conf=None):
+    """Store a password in the vault"""
+    path = get_vault_path(conf)
+    header, secrets, fernet = unlock(path)
+    secrets.setdefault(credential, {})[username] = password
+    save(path, header, secrets, fernet)
+
+
+def import_passwords(passwords, conf=None):
+    """
+    Store many passwords in the vault, given as a dict keyed by
+    (credential, username) pairs
+    """
+    path = get_vault_path(conf)
+    header, secrets, fernet = unlock(path)
+    for (credential, username), password in passwords.items():
+        secrets.setdefault(credential, {})[username] = password
+    save(path, header, secrets, fernet)
@@ -0,0 +1,265 @@
+import os
+import signal
+import sys
+import time
+from os import environ
+from pathlib import Path
+
+from . import backends, cache, creds, files
+from .conf import find_conf_files
+from .logs import KeycmdError, log, vlog, vwarn
+
+DEFAULT_INTERVAL = 60.0
+# seconds to wait for more changes before reloading
+DEBOUNCE = 0.5
+# seconds between checks of the config files, if inotify is not available
+FILE_POLL_INTERVAL = 1.0
+# seconds between checks whether the child process exited
+CHILD_POLL_INTERVAL = 0.2
+# seconds a child process gets to exit before it is killed
+GRACE_PERIOD = 5.0
+# signals that are forwarded to the child process, SIGINT is delivered to
+# the child by the terminal already, as it runs in the same process group
+FORWARD_SIGNALS = ("SIGTERM", "SIGHUP", "SIGQUIT", "SIGUSR1", "SIGUSR2")
+
+# see inotify(7)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+
+
+def get_watch_dirs(paths):
+    """
+    List the folders to watch for changes: the folders between the current
+    working directory and the furthest config file, and the home folder
+    """
+    from .conf import USERPROFILE
+
+    cwd = Path.cwd()
+    dirs = {cwd, Path(USERPROFILE).expanduser().resolve()}
+    dirs.update(path.parent for path in paths)
+    for parent in cwd.parents:
+        if not any(path.is_relative_to(parent) for path in paths):
+            break
+        dirs.add(parent)
+    return dirs
+
+
+def open_inotify():
+    """Create a non-blocking inotify instance, returns None if not supported"""
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        vlog("inotify is not available: %s", os.strerror(ctypes.get_errno()))
+        return None
+    return libc, fd
+
+
+def add_watches(inotify, dirs):
+    """Watch folders for changes, already watched folders are ignored"""
+    libc, fd = inotify
+    for path in dirs:
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_MASK) < 0:
+            vlog("failed to watch %s", path)
+
+
+def read_events(fd, names):
+    """Read all pending inotify events, returns whether any of them are relevant"""
+    import struct
+
+    changed = False
+    while True:
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16 : offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW or os.fsdecode(name) in names:
+                changed = True
+
+
+def fetch_passwords(conf):
+    """
+    Fetch the current password of every credential, bypassing the agent,
+    so rotated credentials are noticed
+    """
+    pairs = creds.get_pairs(conf)
+    fetched = creds.get_passwords(
+        pairs, max_workers=creds.get_max_workers(conf), chain=backends.get_chain(conf)
+    )
+    passwords = dict(zip(pairs, fetched))
+    passwords.update(creds.resolve_vault_passwords(conf))
+    return passwords
+
+
+def start(args, secrets):
+    """Start the child process with the secrets in its environment"""
+    from subprocess import Popen
+
+    env = environ.copy()
+    env.update(secrets)
+    vlog("starting %s", args[0])
+    return Popen(args, env=env, pass_fds=files.get_fds())
+
+
+def stop(child):
+    """Ask the child process to stop, killing it after the grace period"""
+    from subprocess import TimeoutExpired
+
+    if child.poll() is not None:
+        return
+    vlog("stopping process %d", child.pid)
+    child.terminate()
+    try:
+        child.wait(GRACE_PERIOD)
+    except TimeoutExpired:
+        vlog("killing process %d", child.pid)
+        child.kill()
+        child.wait()
+
+
+def watch(args, conf, reload, root_markers=(), interval=DEFAULT_INTERVAL):
+    """
+    Run a command (given as a list of arguments) and restart it with updated
+    secrets whenever the configuration files change, or a credential changes
+    in the keyring (checked every interval seconds). reload is called to load
+    the configuration again, after which only new credentials are fetched.
+    Returns the exit code of the command, once it exits by itself.
+    """
+    import threading
+    from select import select
+
+    passwords = {}
+    secrets = creds.get_secrets(conf, cache=passwords)
+    names = {".keycmd", "pyproject.toml", ".git", *root_markers}
+    paths = [path for path, _ in find_conf_files(root_markers=root_markers)]
+    fingerprint = cache.fingerprint(paths)
+    inotify = open_inotify()
+    if inotify is not None:
+        add_watches(inotify, get_watch_dirs(paths))
+    else:
+        vlog("polling config files for changes")
+
+    child = start(args, secrets)
+
+    def forward(signum, frame):
+        vlog("forwarding signal %d to process %d", signum, child.pid)
+        if child.poll() is None:
+            child.send_signal(signum)
+
+    handlers = {}
+    # signal handlers can only be installed in the main thread
+    if threading.current_thread() is threading.main_thread():
+        for name in FORWARD_SIGNALS:
+            signum = getattr(signal, name, None)
+            if signum is not None:
+                handlers[signum] = signal.signal(signum, forward)
+
+    now = time.monotonic()
+    next_poll = now + interval
+    next_check = now + FILE_POLL_INTERVAL
+    last_change = None
+    try:
+        while True:
+            code = child.poll()
+            if code is not None:
+                vlog("command exited with code %d", code)
+                return code
+
+            now = time.monotonic()
+            wakeups = [next_poll, now + CHILD_POLL_INTERVAL]
+            if last_change is not None:
+                wakeups.append(last_change + DEBOUNCE)
+            if inotify is None:
+                wakeups.append(next_check)
+            timeout = max(0, min(wakeups) - now)
+            if inotify is not None:
+                try:
+                    ready, _, _ = select([inotify[1]], [], [], timeout)
+                except InterruptedError:
+                    ready = []
+                if ready and read_events(inotify[1], names):
+                    last_change = time.monotonic()
+            else:
+                time.sleep(timeout)
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + FILE_POLL_INTERVAL
+                    paths = [
+                        path for path, _ in find_conf_files(root_markers=root_markers)
+                    ]
+                    current = cache.fingerprint(paths)
+                    if current != fingerprint:
+                        fingerprint = current
+                        last_change = time.monotonic()
+
+            now = time.monotonic()
+            new_secrets = None
+            if last_change is not None and now - last_change >= DEBOUNCE:
+                last_change = None
+                try:
+                    conf = reload()
+                    # forget credentials that are no longer used
+                    used = {creds.get_pair(src) for src in conf["keys"].values()}
+                    for pair in set(passwords) - used:
+                        del passwords[pair]
+                    new_secrets = creds.get_secrets(conf, cache=passwords)
+                except KeycmdError as err:
+                    log(f"failed to reload configuration: {err}", err=True)
+                if inotify is not None:
+                    paths = [
+                        path for path, _ in find_conf_files(root_markers=root_markers)
+                    ]
+                    add_watches(inotify, get_watch_dirs(paths))
+            elif now >= next_poll:
+                next_poll = now + interval
+                try:
+                    fresh = fetch_passwords(conf)
+                    changed = [
+                        pair for pair, pw in fresh.items() if pw != passwords.get(pair)
+                    ]
+                    if changed:
+                        vlog("%d credentials changed", len(changed))
+                        passwords.update(fresh)
+                        new_secrets = creds.expose_secrets(conf, passwords)
+                except Exception as err:
+                    # e.g. the keyring is briefly unavailable, the command keeps
+                    # running and the credentials are checked again next interval
+                    vwarn("failed to refresh credentials: %s", err)
+
+            if new_secrets is not None and new_secrets != secrets:
+                log("secrets changed, restarting command", err=True)
+                secrets = new_secrets
+                stop(child)
+                files.prune(secrets)
+                child = start(args, secrets)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        if inotify is not None:
+            os.close(inotify[1])
+        stop(child)
@@ -0,0 +1,144 @@
+import threading
+import time
+
+import keyring
+import pytest
+
+import keycmd.agent
+from keycmd.agent import Agent, flush, get_passwords, serve
+from keycmd.creds import resolve_passwords
+
+pytestmark = pytest.mark.skipif(
+    not keycmd.agent.IS_SUPPORTED, reason="agent requires unix sockets"
+)
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def get_password(credential, username):
+        calls.append((credential, username))
+        if credential == "missing":
+            return None
+        return f"{credential}:{username}"
+
+    monkeypatch.setattr(keyring, "get_password", get_password)
+    yield calls
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    path = tmp_path / "agent.sock"
+    monkeypatch.setenv("KEYCMD_AGENT_SOCK", str(path))
+    yield path
+
+
+@pytest.fixture
+def running_agent(socket_path, calls):
+    thread = threading.Thread(target=serve, kwargs={"idle_timeout": 2.0}, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if socket_path.exists():
+            break
+        time.sleep(0.01)
+    yield socket_path
+    thread.join()
+    assert not socket_path.exists()
+
+
+def test_agent_cache(calls):
+    agent = Agent(ttl=60)
+    assert agent.get_passwords([("a", "b"), ("missing", "b")]) == ["a:b", None]
+    assert agent.get_passwords([("a", "b"), ("missing", "b")]) == ["a:b", None]
+    # missing credentials are not cached
+    assert calls == [("a", "b"), ("missing", "b"), ("missing", "b")]
+
+    agent.flush()
+    assert agent.get_passwords([("a", "b")]) == ["a:b"]
+    assert calls[-1] == ("a", "b")
+
+
+def test_agent_ttl(calls):
+    agent = Agent(ttl=0)
+    agent.get_passwords([("a", "b")])
+    agent.get_passwords([("a", "b")])
+    assert calls == [("a", "b"), ("a", "b")]
+
+
+def test_agent_missing(socket_path):
+    assert get_passwords([("a", "b")]) is None
+    with pytest.raises(SystemExit):
+        flush()
+
+
+def test_agent_serve(running_agent, calls, capsys):
+    assert running_agent.stat().st_mode & 0o077 == 0
+    assert get_passwords([("a", "b")]) == ["a:b"]
+    assert get_passwords([("a", "b")]) == ["a:b"]
+    assert calls == [("a", "b")]
+
+    conf = {"keys": {"A": {"credential": "a", "username": "b"}}}
+    assert resolve_passwords(conf) == {("a", "b"): "a:b"}
+    assert calls == [("a", "b")]
+
+    flush()
+    assert "agent cache flushed" in capsys.readouterr().out
+    assert get_passwords([("a", "b")]) == ["a:b"]
+    assert calls == [("a", "b"), ("a", "b")]
+
+
+def test_agent_untrusted(tmp_path):
+    folder = tmp_path / "folder"
+    folder.mkdir(mode=0o700)
+    path = folder / "agent.sock"
+    path.touch(mode=0o600)
+    assert keycmd.agent.is_trusted(path)
+    path.chmod(0o666)
+    assert not keycmd.agent.is_trusted(path)
+    assert keycmd.agent.request({"op": "ping"}, path=path) is None
+    path.chmod(0o600)
+    folder.chmod(0o777)
+    assert not keycmd.agent.is_trusted(path)
+    # like /tmp
+    folder.chmod(0o1777)
+    assert keycmd.agent.is_trusted(path)
+
+
+def test_agent_invalid_response(tmp_path):
+    import socket
+
+    path = tmp_path / "agent.sock"
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    server.listen(1)
+
+    def reply():
+        connection, _ = server.accept()
+        with connection:
+            connection.recv(1024)
+            connection.sendall(b"not json\n")
+
+    thread = threading.Thread(target=reply, daemon=True)
+    thread.start()
+    try:
+        assert keycmd.agent.request({"op": "ping"}, path=path) is None
+    finally:
+        thread.join(2)
+        server.close()
+
+
+def test_agent_serve_user_folder(tmp_path, monkeypatch, calls):
+    # a folder chosen by the user is not made private
+    tmp_path.chmod(0o755)
+    path = tmp_path / "agent.sock"
+    monkeypatch.setenv("KEYCMD_AGENT_SOCK", str(path))
+    thread = threading.Thread(target=serve, kwargs={"idle_timeout": 0.5}, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if path.exists():
+            break
+        time.sleep(0.01)
+    assert get_passwords([("a", "u")]) == ["a:u"]
+    assert tmp_path.stat().st_mode & 0o777 == 0o755
+    thread.join()
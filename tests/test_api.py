@@ -0,0 +1,113 @@
+import asyncio
+import os
+from pathlib import Path
+
+import keyring
+import pytest
+
+import keycmd
+import keycmd.conf
+
+
+@pytest.fixture(autouse=True)
+def invalidate():
+    keycmd.invalidate()
+    yield
+    keycmd.invalidate()
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def get_password(credential, username):
+        calls.append((credential, username))
+        if credential == "missing":
+            return None
+        return f"{credential}:{username}"
+
+    monkeypatch.setattr(keyring, "get_password", get_password)
+    yield calls
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    user_dir = tmp_path / ".user"
+    user_dir.mkdir()
+    monkeypatch.setattr(keycmd.conf, "USERPROFILE", user_dir)
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / ".git").mkdir()
+    (project / ".keycmd").write_text(
+        """[keys]
+__KEYCMD_A = { credential = "a", username = "u" }
+__KEYCMD_B = { credential = "b", username = "u" }
+
+[aliases]
+__KEYCMD_A_B64 = { key = "__KEYCMD_A", b64 = true }
+
+[profiles.b]
+keys = ["__KEYCMD_B"]
+""",
+        encoding="utf-8",
+    )
+    yield project
+
+
+def test_resolve(project, calls):
+    secrets = keycmd.resolve(cwd=project)
+    assert secrets == {
+        "__KEYCMD_A": "a:u",
+        "__KEYCMD_B": "b:u",
+        "__KEYCMD_A_B64": "YTp1",
+    }
+    assert keycmd.resolve(cwd=project) == secrets
+    assert sorted(calls) == [("a", "u"), ("b", "u")]
+
+    assert keycmd.resolve(cwd=project, profile="b") == {"__KEYCMD_B": "b:u"}
+    assert len(calls) == 2
+
+    keycmd.invalidate(conf=False)
+    keycmd.resolve(cwd=project, only=["__KEYCMD_A"])
+    assert calls[2:] == [("a", "u")]
+
+
+def test_resolve_async(project, calls):
+    secrets = asyncio.run(keycmd.resolve_async(cwd=project, only="__KEYCMD_B"))
+    assert secrets == {"__KEYCMD_B": "b:u"}
+    assert keycmd.resolve(cwd=project, only="__KEYCMD_B") == secrets
+    assert calls == [("b", "u")]
+
+
+def test_resolve_conf_memoized(project, calls):
+    keycmd.resolve(cwd=project)
+    (project / ".keycmd").write_text("[keys]\n", encoding="utf-8")
+    assert "__KEYCMD_A" in keycmd.resolve(cwd=project)
+    keycmd.invalidate(secrets=False)
+    assert keycmd.resolve(cwd=project) == {}
+
+
+def test_resolve_missing(project, calls):
+    (project / ".keycmd").write_text(
+        '[keys]\nFOO = { credential = "missing", username = "u" }\n',
+        encoding="utf-8",
+    )
+    with pytest.raises(keycmd.KeycmdError):
+        keycmd.resolve(cwd=project)
+
+
+def test_resolve_invalid_toml(project, calls):
+    (project / ".keycmd").write_text("[keys", encoding="utf-8")
+    with pytest.raises(keycmd.KeycmdError, match="INVALID TOML"):
+        keycmd.resolve(cwd=project)
+
+
+def test_injected(project, calls, monkeypatch):
+    monkeypatch.setenv("__KEYCMD_B", "previous")
+    with keycmd.injected(cwd=project) as secrets:
+        assert os.environ["__KEYCMD_A"] == "a:u"
+        assert os.environ["__KEYCMD_B"] == "b:u"
+        assert secrets["__KEYCMD_A_B64"] == "YTp1"
+    assert "__KEYCMD_A" not in os.environ
+    assert os.environ["__KEYCMD_B"] == "previous"
+    assert Path.cwd() != project
@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from keycmd import KeycmdError, backends
+
+
+class FakeBackend:
+    def __init__(self, password=None, delay=0.0, fail=False):
+        self.password = password
+        self.delay = delay
+        self.fail = fail
+        self.calls = []
+
+    def get_password(self, credential, username):
+        self.calls.append((credential, username))
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("locked")
+        return self.password
+
+    def __str__(self):
+        return f"FakeBackend({self.password})"
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    fakes = {
+        "missing": FakeBackend(),
+        "failing": FakeBackend(fail=True),
+        "slow": FakeBackend("slow", delay=1.0),
+        "fast": FakeBackend("fast"),
+    }
+    monkeypatch.setattr(backends, "_backends", dict(fakes))
+    yield fakes
+
+
+def test_get_chain(fakes):
+    assert backends.get_chain({"keys": {}}) is None
+    conf = {
+        "settings": {
+            "backends": ["missing", {"name": "slow", "timeout": 0.5}],
+            "backend_timeout": 2,
+            "hedge_ms": 50,
+        }
+    }
+    assert backends.get_chain(conf) == (
+        [(fakes["missing"], 2), (fakes["slow"], 0.5)],
+        0.05,
+    )
+
+    for settings in [
+        {"backends": []},
+        {"backends": "fast"},
+        {"backends": [{"timeout": 1}]},
+        {"backends": ["fast"], "hedge_ms": -1},
+        {"backends": [{"name": "fast", "timeout": True}]},
+    ]:
+        with pytest.raises(KeycmdError, match="INVALID setting"):
+            backends.get_chain({"settings": settings})
+
+
+def test_get_chain_load_error():
+    with pytest.raises(KeycmdError, match="INVALID keyring backend"):
+        backends.get_chain({"settings": {"backends": ["keycmd.NoSuchKeyring"]}})
+
+
+def chain(fakes, *names, timeout=None, hedge=None):
+    return [(fakes[name], timeout) for name in names], hedge
+
+
+def test_get_password(fakes):
+    pair = ("cred", "user")
+    assert backends.get_password(pair, chain(fakes, "missing", "fast")) == "fast"
+    assert fakes["missing"].calls == [pair]
+    assert backends.get_password(pair, chain(fakes, "failing", "fast")) == "fast"
+    assert backends.get_password(pair, chain(fakes, "missing", "failing")) is None
+    assert backends.get_password(pair, chain(fakes, "fast", "missing")) == "fast"
+    assert len(fakes["missing"].calls) == 2
+
+
+def test_get_password_timeout(fakes):
+    start = time.monotonic()
+    password = backends.get_password(
+        ("cred", "user"), chain(fakes, "slow", "fast", timeout=0.1)
+    )
+    assert password == "fast"
+    assert time.monotonic() - start < 0.5
+
+
+def test_get_password_hedge(fakes):
+    start = time.monotonic()
+    password = backends.get_password(
+        ("cred", "user"), chain(fakes, "slow", "fast", hedge=0.05)
+    )
+    assert password == "fast"
+    assert time.monotonic() - start < 0.5
+
+    # without hedging, the primary is the source of truth
+    password = backends.get_password(("cred", "user"), chain(fakes, "slow", "fast"))
+    assert password == "slow"
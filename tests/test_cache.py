@@ -0,0 +1,75 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import keycmd.cache
+from keycmd.cache import clear, fingerprint, get_cache_dir, read, write
+from keycmd.shell import write_shell_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "cache"
+    monkeypatch.setattr(keycmd.cache, "CACHE_DIR", path)
+    yield path
+
+
+def test_get_cache_dir(cache_dir):
+    assert get_cache_dir() == cache_dir
+
+
+def test_fingerprint(tmp_path):
+    path = tmp_path / "foo.toml"
+    path.write_text("[keys]", encoding="utf-8")
+    first = fingerprint([path])
+    assert first == fingerprint([path])
+    path.write_text("[keys]\n", encoding="utf-8")
+    assert first != fingerprint([path])
+
+
+def test_read_write(tmp_path, cache_dir):
+    path = tmp_path / "foo.toml"
+    path.write_text("[keys]", encoding="utf-8")
+    paths = [path]
+    assert read("conf", paths) is None
+
+    write("conf", paths, fingerprint(paths), {"keys": {}})
+    assert read("conf", paths) == {"keys": {}}
+    assert read("conf", [Path(tmp_path / "bar.toml")]) is None
+
+    # changing a file invalidates the cache
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert read("conf", paths) is None
+
+    # removing a file invalidates the cache
+    write("conf", paths, fingerprint(paths), {"keys": {}})
+    path.unlink()
+    assert read("conf", paths) is None
+
+
+def test_read_corrupt(tmp_path, cache_dir):
+    paths = [tmp_path]
+    write("conf", paths, fingerprint(paths), {"keys": {}})
+    for cache_file in cache_dir.iterdir():
+        cache_file.write_bytes(b"garbage")
+    assert read("conf", paths) is None
+
+
+def test_clear(tmp_path, cache_dir):
+    assert clear() == 0
+    paths = [tmp_path]
+    write("conf", paths, fingerprint(paths), {"keys": {}})
+    assert clear() == 1
+    assert read("conf", paths) is None
+
+
+def test_clear_all_files(tmp_path, cache_dir):
+    paths = [tmp_path]
+    write("conf", paths, fingerprint(paths), {"keys": {}})
+    write_shell_cache("key", "bash", "/bin/bash")
+    (cache_dir / "conf-foo.1234.tmp").touch()
+    (cache_dir / "other.txt").touch()
+    assert clear() == 3
+    assert [path.name for path in cache_dir.iterdir()] == ["other.txt"]
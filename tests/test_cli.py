@@ -1,15 +1,21 @@
+import io
+import json
 import os
-from functools import cache
+import sys
+import time
+from functools import cache, partial
 from pathlib import Path
 from subprocess import run
 
 import keyring
 import pytest
 
+import keycmd.cache
 import keycmd.conf
 import keycmd.shell
 from keycmd import __version__
 from keycmd.cli import cli, main
+from keycmd.logs import set_verbose
 from keycmd.shell import get_shell
 
 varname = "KEYCMD_TEST"
@@ -48,6 +54,13 @@ def userprofile(tmpdir, monkeypatch):
     yield user_dir
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    cache_dir = Path(tmpdir) / ".cache"
+    monkeypatch.setattr(keycmd.cache, "CACHE_DIR", cache_dir)
+    yield cache_dir
+
+
 @pytest.fixture
 def local_conf(ch_tmpdir):
     Path(".keycmd").write_text(
@@ -115,3 +128,217 @@ def test_cli_extra_args():
     args = cli.parse_args(command)
     assert args.command == command[1:]
     assert args.version is True
+
+
+def test_cli_commands(
+    capfd, ch_tmpdir, credentials, local_conf, userprofile, monkeypatch
+):
+    calls = []
+    get_password = keyring.get_password
+    monkeypatch.setattr(
+        keyring, "get_password", lambda *args: calls.append(args) or get_password(*args)
+    )
+    Path("commands.txt").write_text(
+        "# a comment\n\npython --version\npython --version\n", encoding="utf-8"
+    )
+    with pytest.raises(SystemExit) as exc_info:
+        main(["--commands", "commands.txt", "-j", "2"])
+    assert exc_info.value.args[0] == 0
+    assert len(capfd.readouterr().out.splitlines()) == 2
+    assert len(calls) == 1
+
+
+def test_cli_export(capfd, ch_tmpdir, credentials, local_conf, userprofile, request):
+    request.addfinalizer(partial(set_verbose, False))
+    main(["-v", "--export", "json"])
+    out, err = capfd.readouterr()
+    assert json.loads(out) == {varname: password}
+    assert "loading config file" in err
+
+
+def test_cli_only(capfd, ch_tmpdir, credentials, local_conf, userprofile):
+    with Path(".keycmd").open("a", encoding="utf-8") as fh:
+        fh.write('MISSING = { credential = "missing", username = "missing" }\n')
+    with pytest.raises(SystemExit):
+        main(["--export", "json"])
+    capfd.readouterr()
+    main(["--only", varname, "--export", "json"])
+    assert json.loads(capfd.readouterr().out) == {varname: password}
+
+
+def test_cli_file(capfd, ch_tmpdir, credentials, local_conf, userprofile, subprocess):
+    name, _ = get_shell()
+    if name not in {"bash", "zsh", "sh", "fish"}:
+        pytest.skip("requires a posix shell")
+    with Path(".keycmd").open("a", encoding="utf-8") as fh:
+        fh.write(f'[aliases]\nFILE = {{ key = "{varname}", file = true }}\n')
+    with pytest.raises(SystemExit):
+        main(["cat", "$FILE"])
+    assert capfd.readouterr().out == password
+    with pytest.raises(SystemExit):
+        main(["--export", "json"])
+    assert "secret files can't be exported" in capfd.readouterr().err
+
+
+def test_cli_profile_lookups(capfd, ch_tmpdir, userprofile, monkeypatch):
+    lookups = []
+
+    def get_password(credential, username):
+        lookups.append(credential)
+        return credential
+
+    monkeypatch.setattr(keyring, "get_password", get_password)
+    monkeypatch.setenv("KEYCMD_AGENT_SOCK", str(Path(ch_tmpdir) / "agent.sock"))
+    keys = "\n".join(
+        f'{k} = {{ credential = "{k.lower()}", username = "u" }}' for k in "ABCD"
+    )
+    Path(".keycmd").write_text(
+        f'[keys]\n{keys}\n[profiles]\np = {{ keys = ["A"] }}\n', encoding="utf-8"
+    )
+    main(["--no-cache", "--profile", "p", "--export", "json"])
+    assert json.loads(capfd.readouterr().out) == {"A": "a"}
+    assert lookups == ["a"]
+
+
+@pytest.mark.parametrize("settings", ['shell = "/bin/sh"', "exec = true"])
+def test_cli_no_detection(
+    settings, capfd, ch_tmpdir, credentials, local_conf, userprofile, monkeypatch
+):
+    if os.name == "nt":
+        pytest.skip("requires a posix shell")
+    calls = []
+    monkeypatch.setattr(keycmd.shell, "USE_SUBPROCESS", True)
+    monkeypatch.setattr(keycmd.shell, "_detection", None)
+    monkeypatch.setattr(keycmd.shell, "detect_parent_shell", lambda: calls.append(1))
+    with Path(".keycmd").open("a", encoding="utf-8") as fh:
+        fh.write(f"[settings]\n{settings}\n")
+    with pytest.raises(SystemExit):
+        main(["--no-cache", "echo", "hi"])
+    assert capfd.readouterr().out.strip() == "hi"
+    assert keycmd.shell._detection is None
+    assert calls == []
+
+
+def test_cli_vault(capfd, ch_tmpdir, credentials, local_conf, userprofile, monkeypatch):
+    pytest.importorskip("cryptography")
+    monkeypatch.setenv("KEYCMD_VAULT", str(Path(ch_tmpdir) / "vault"))
+    monkeypatch.setenv("KEYCMD_VAULT_PASSPHRASE", "hunter2")
+    monkeypatch.setattr("keycmd.vault.SCRYPT_N", 2**10)
+    monkeypatch.setattr(sys, "stdin", io.StringIO("set password\n"))
+    main(["--vault", "set", "cred", "user"])
+    main(["--vault", "get", "cred", "user"])
+    assert capfd.readouterr().out.splitlines()[-1] == "set password"
+
+    # copy the keyring credentials of the configuration into the vault
+    main(["--vault", "import"])
+    with Path(".keycmd").open("a", encoding="utf-8") as fh:
+        fh.write(
+            'VAULT = { credential = "cred", username = "user", source = "vault" }\n'
+        )
+    main(["--export", "json"])
+    out = capfd.readouterr().out
+    assert json.loads(out[out.index("{") :]) == {
+        varname: password,
+        "VAULT": "set password",
+    }
+
+
+def test_cli_clear_cache(capfd, cache_dir):
+    cache_dir.mkdir()
+    (cache_dir / "conf-foo.pickle").touch()
+    main(["--clear-cache"])
+    assert "removed 1 cache files" in capfd.readouterr().out
+    assert not list(cache_dir.iterdir())
+
+
+# modules that should only be imported on the code paths that need them
+LAZY_MODULES = {"keyring", "tomli", "shellingham", "pprint", "subprocess"}
+# generous wall-clock budgets (in seconds) on top of bare interpreter startup
+STARTUP_BUDGET = 0.5
+VERSION_BUDGET = 0.2
+KEY_BUDGET = 0.05
+
+
+def run_timed(code, cwd=None):
+    """Run python code in a fresh interpreter, returning the best wall-clock
+    time of a few runs and the names of the modules that were imported"""
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        p = run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            check=True,
+            cwd=cwd,
+        )
+        timings.append(time.perf_counter() - start)
+    modules = set()
+    for line in p.stderr.decode("utf-8").splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return min(timings), modules
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    duration, _ = run_timed("pass")
+    return duration
+
+
+def test_startup_version(baseline):
+    duration, modules = run_timed("from keycmd.cli import main; main(['--version'])")
+    assert not modules.intersection(LAZY_MODULES)
+    assert duration < baseline + VERSION_BUDGET
+
+
+def test_startup_version_modules():
+    code = """
+import json, sys
+from keycmd.cli import main
+main(["--version"])
+print(json.dumps(sorted(sys.modules)))
+"""
+    p = run([sys.executable, "-c", code], capture_output=True, check=True)
+    modules = set(json.loads(p.stdout.decode("utf-8").splitlines()[-1]))
+    assert not modules.intersection(
+        {
+            "keycmd.agent",
+            "keycmd.cache",
+            "keycmd.conf",
+            "keycmd.creds",
+            "concurrent.futures",
+            "logging",
+        }
+    )
+
+
+def test_startup_empty_conf(baseline, tmpdir):
+    code = f"""
+import keycmd.conf
+keycmd.conf.USERPROFILE = {str(tmpdir)!r}
+from keycmd.conf import load_conf
+from keycmd.creds import get_env
+get_env(load_conf())
+"""
+    duration, modules = run_timed(code, cwd=tmpdir)
+    assert not modules.intersection(LAZY_MODULES)
+    assert duration < baseline + STARTUP_BUDGET
+
+
+def test_startup_keys(baseline, tmpdir, credentials):
+    n = 20
+    keys = "\n".join(
+        f'KEY_{i} = {{ credential = "{key}", username = "{username}" }}'
+        for i in range(n)
+    )
+    Path(tmpdir / ".keycmd").write_text(f"[keys]\n{keys}\n", encoding="utf-8")
+    code = f"""
+import keycmd.conf
+keycmd.conf.USERPROFILE = {str(tmpdir)!r}
+from keycmd.conf import load_conf
+from keycmd.creds import get_env
+assert len([k for k in get_env(load_conf()) if k.startswith("KEY_")]) == {n}
+"""
+    duration, modules = run_timed(code, cwd=tmpdir)
+    assert "keyring" in modules
+    assert duration < baseline + STARTUP_BUDGET + n * KEY_BUDGET
@@ -1,17 +1,24 @@
 import os
+import pickle
 from pathlib import Path
 
 import pytest
 import tomli
 
+import keycmd.cache
+from keycmd import KeycmdError
 import keycmd.conf
 from keycmd.conf import (
     defaults,
     find_file,
+    find_files,
     load_conf,
     load_pyproj,
     load_toml,
-    merge_conf,
+    Overlay,
+    scan_dir,
+    scan_pyproj,
+    select_conf,
 )
 
 
@@ -33,7 +40,7 @@ def test_load_toml(ch_tmpdir):
 
     path = Path("baz.toml")
     path.write_text("[keys}", encoding="utf-8")
-    with pytest.raises(tomli.TOMLDecodeError) as err:
+    with pytest.raises(KeycmdError) as err:
         load_toml(path)
     assert path.name in err.value.args[0]
 
@@ -48,13 +55,85 @@ def test_load_pyproj(ch_tmpdir):
     with pytest.raises(FileNotFoundError) as err:
         load_pyproj(path)
 
+    # files without a keycmd section are not parsed
     path = Path("pyproject.toml")
     path.write_text("[keys}", encoding="utf-8")
-    with pytest.raises(tomli.TOMLDecodeError) as err:
+    assert load_pyproj(path) == {}
+
+    path.write_text("[tool.keycmd.keys}", encoding="utf-8")
+    with pytest.raises(KeycmdError) as err:
         load_pyproj(path)
     assert path.name in err.value.args[0]
 
 
+PYPROJECT = '''
+name = "root"
+
+[project]
+name = "foo"
+dependencies = [
+  "keyring",
+]
+
+[tool.poetry]
+description = """
+[tool.poetry.dependencies]
+NOT_A_KEY = 1
+"""
+matrix = [
+  [1, 2],
+  [3]
+]
+
+[tool.keycmd.keys]  # comment
+A = { credential = "a", username = "u" }
+
+[project.scripts]
+keycmd = "keycmd.cli:main"
+
+[[tool.poetry.source]]
+name = "keycmd"
+
+[ tool . keycmd . aliases ]
+B = { key = "A", format = """
+[x]""" }
+
+[tool.keycmdx]
+C = 1
+'''
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "[tool]\nkeycmd = { keys = {} }\n",
+        "[tool]\nkeycmd.keys.A = { credential = 'a', username = 'u' }\n",
+        "tool.keycmd.keys.A = { credential = 'a', username = 'u' }\n",
+        "tool = { keycmd = {} }\n",
+        '["tool".keycmd.keys]\nA = { credential = "a", username = "u" }\n',
+        "[project]\nx = [\n[tool.keycmd.keys]\n]\n",
+        "[project]\nx = '''\nkeycmd\n'''\n",
+        '[project]\nx = """\n[tool.keycmd.keys]\n"""\n',
+    ],
+)
+def test_scan_pyproj_fallback(text):
+    assert scan_pyproj(text) is None
+
+
+def test_scan_pyproj(ch_tmpdir):
+    text = scan_pyproj(PYPROJECT)
+    assert "NOT_A_KEY" not in text
+    assert "C = 1" not in text
+    expected = tomli.loads(PYPROJECT)["tool"]["keycmd"]
+    assert tomli.loads(text)["tool"]["keycmd"] == expected
+
+    path = Path("pyproject.toml")
+    path.write_text(PYPROJECT, encoding="utf-8")
+    assert load_pyproj(path) == expected
+    path.write_text("[tool]\nkeycmd.keys.A = 1\n", encoding="utf-8")
+    assert load_pyproj(path) == {"keys": {"A": 1}}
+
+
 def create_path(p):
     p = Path(p).expanduser().resolve()
     p.parent.mkdir(exist_ok=True, parents=True)
@@ -73,7 +152,63 @@ def test_find_file(ch_tmpdir):
     assert find_file(".blabla", first_only=False) == [p2, p1]
 
 
-def test_merge_conf():
+def test_find_files(ch_tmpdir):
+    p1 = create_path("../.blabla")
+    p2 = create_path("../../.blabla")
+    p3 = create_path("../../pyproject.toml")
+    p4 = create_path("../../../pyproject.toml")
+    found = find_files([".blabla", "pyproject.toml"])
+    assert found == {".blabla": [p1, p2], "pyproject.toml": [p3, p4]}
+
+    create_path("../.keycmd-root")
+    found = find_files([".blabla", "pyproject.toml"], root_markers=[".keycmd-root"])
+    assert found == {".blabla": [p1], "pyproject.toml": []}
+
+    (p2.parent / ".git").mkdir(exist_ok=True, parents=True)
+    found = find_files([".blabla", "pyproject.toml"])
+    assert found == {".blabla": [p1, p2], "pyproject.toml": [p3]}
+
+
+def test_scan_dir(tmp_path, monkeypatch):
+    if os.name == "nt":
+        pytest.skip("creating symlinks requires privileges on windows")
+    project = tmp_path / "project"
+    project.mkdir()
+    (tmp_path / "real.keycmd").touch()
+    (project / ".keycmd").symlink_to(tmp_path / "real.keycmd")
+    (project / "pyproject.toml").touch()
+    (project / ".git").mkdir()
+    files, is_git_root, calls = scan_dir(project, {".keycmd", "pyproject.toml"})
+    assert files == {".keycmd": True, "pyproject.toml": False}
+    assert is_git_root
+    # the scandir call, and following the symlink
+    assert calls == 2
+
+    # the symlink status from scan_dir is reused
+    def is_symlink(self):
+        raise AssertionError("not expected to lstat again")
+
+    monkeypatch.setattr(Path, "is_symlink", is_symlink)
+    found = find_files([".keycmd", "pyproject.toml"], cwd=project)
+    assert found == {
+        ".keycmd": [(tmp_path / "real.keycmd").resolve()],
+        "pyproject.toml": [project.resolve() / "pyproject.toml"],
+    }
+
+
+def merge(a, b):
+    """Merge two layers eagerly, the way Overlay merges them on access"""
+    a = a.copy()
+    for key, value in b.items():
+        if isinstance(value, dict):
+            old_value = a.get(key)
+            a[key] = merge(old_value if isinstance(old_value, dict) else {}, value)
+        else:
+            a[key] = value
+    return a
+
+
+def test_overlay_merge():
     a = {
         "keys": {
             "foo": {
@@ -96,8 +231,7 @@ def test_merge_conf():
         },
     }
 
-    c = merge_conf(a, b)
-    assert c == {
+    assert Overlay([(a, "a"), (b, "b")]) == {
         "something": "else",
         "keys": {
             "foo": {"bla": "blabla"},
@@ -105,15 +239,38 @@ def test_merge_conf():
             "baz": {"bla": "bla"},
         },
     }
-
-    d = {}
-    e = merge_conf(a, d)
-    assert e == {
+    assert Overlay([(a, "a"), ({}, "d")]) == {
         "keys": {
             "foo": {"bla": "bla"},
             "bar": {"bla": "bla"},
         },
     }
+    # a table only merges with the tables set since the last other value
+    e = {"keys": "none"}
+    f = {"keys": {"qux": {"bla": "bla"}}}
+    overlay = Overlay([(a, "a"), (e, "e"), (f, "f")])
+    assert overlay == {"keys": {"qux": {"bla": "bla"}}}
+    assert overlay == merge(merge(a, e), f)
+
+
+def test_overlay():
+    a = {"keys": {"foo": {"bla": "bla", "x": 1}, "bar": {"bla": "bla"}}}
+    b = {"something": "else", "keys": {"foo": {"bla": "blabla"}, "baz": {}}}
+    c = {"something": ["other"], "keys": {"bar": {"y": True}}}
+    layers = [({"keys": {}}, "defaults"), (a, "a"), (b, "b"), (c, "c")]
+    overlay = Overlay(layers)
+    merged = merge(merge(merge({"keys": {}}, a), b), c)
+    assert overlay == merged
+    assert list(overlay["keys"]) == list(merged["keys"])
+    assert len(overlay["keys"]) == 3
+    assert overlay["keys"]["foo"]["x"] == 1
+    assert overlay.get("missing") is None
+
+    assert overlay.source("something") == "c"
+    assert overlay["keys"].source("foo") == "b"
+    assert overlay["keys"]["foo"].source("x") == "a"
+
+    assert pickle.loads(pickle.dumps(overlay)) == merged
 
 
 def create_pyproj_conf(relpath="."):
@@ -286,3 +443,60 @@ e = { foo = "quux" }
             },
         },
     }
+
+
+def test_load_conf_cache(ch_tmpdir, userprofile, monkeypatch):
+    monkeypatch.setattr(keycmd.cache, "CACHE_DIR", userprofile / "cache")
+    create_user_conf()
+    assert load_conf(use_cache=True) == load_conf()
+
+    def fail(path):
+        raise AssertionError("config file should not be parsed")
+
+    with monkeypatch.context() as m:
+        m.setattr(keycmd.conf, "load_toml", fail)
+        conf = load_conf(use_cache=True)
+    assert conf["keys"]["a"] == {"foo": "baz"}
+
+    # adding a config file invalidates the cache
+    create_local_conf()
+    conf = load_conf(use_cache=True)
+    assert conf["keys"]["a"] == {"foo": "quux"}
+
+
+def test_select_conf():
+    conf = {
+        "keys": {
+            "A": {"credential": "a", "username": "u"},
+            "B": {"credential": "b", "username": "u"},
+            "C": {"credential": "c", "username": "u"},
+        },
+        "aliases": {
+            "A_B64": {"key": "A", "b64": True},
+            "C_B64": {"key": "C", "b64": True},
+            "C_B64_ALIAS": {"key": "C_B64"},
+        },
+        "profiles": {
+            "npm": {"keys": ["A_B64"]},
+            "pip": {"keys": ["B"]},
+        },
+    }
+    assert select_conf(conf) is conf
+
+    selected = select_conf(conf, profiles=["npm"])
+    assert list(selected["keys"]) == ["A"]
+    assert list(selected["aliases"]) == ["A_B64"]
+
+    selected = select_conf(conf, profiles=["npm", "pip"], only=["C"])
+    assert list(selected["keys"]) == ["A", "B", "C"]
+    assert list(selected["aliases"]) == ["A_B64"]
+    assert selected["profiles"] == conf["profiles"]
+
+    selected = select_conf(conf, only=["C_B64_ALIAS"])
+    assert list(selected["keys"]) == ["C"]
+    assert list(selected["aliases"]) == ["C_B64", "C_B64_ALIAS"]
+
+    with pytest.raises(KeycmdError):
+        select_conf(conf, profiles=["missing"])
+    with pytest.raises(KeycmdError):
+        select_conf(conf, only=["MISSING"])
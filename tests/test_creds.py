@@ -1,9 +1,25 @@
+import asyncio
+import threading
+import time
 from os import environ
 
 import keyring
 import pytest
 
-from keycmd.creds import b64, get_env
+from keycmd import KeycmdError
+from keycmd.creds import (
+    DEFAULT_MAX_WORKERS,
+    b64,
+    compile_format,
+    expose_secrets,
+    get_env,
+    get_max_workers,
+    get_passwords,
+    get_secrets_async,
+    sort_aliases,
+    resolve_passwords,
+    transform,
+)
 
 
 def test_b64():
@@ -71,3 +87,201 @@ def test_get_env(credentials):
     assert env.get("__FOOBAR_BASICAUTH_ALIAS2") == b64(f"{username}:{password}")
     assert set(environ.keys()).intersection(set(env.keys())) == set(environ.keys())
     assert set(environ.keys()).symmetric_difference(set(env.keys())) == set(all_keys)
+
+
+def test_compile_format():
+    template = compile_format("{username}:{password}")
+    assert template is compile_format("{username}:{password}")
+    assert template("cred", "user", "pass") == "user:pass"
+    assert compile_format("{{literal}}")("cred", "user", "pass") == "{literal}"
+    assert compile_format("{password!r:>8}")("c", "u", "pass") == "  'pass'"
+    for format_string in ("{foo}", "{}", "{0}", "{password"):
+        with pytest.raises(KeycmdError, match="INVALID format string"):
+            compile_format(format_string)
+
+
+def test_sort_aliases():
+    keys = {"A": {}, "B": {}}
+    aliases = {
+        "C": {"key": "D"},
+        "D": {"key": "E"},
+        "E": {"key": "A"},
+        "F": {"key": "B"},
+    }
+    assert sort_aliases(keys, aliases) == ["E", "D", "C", "F"]
+    with pytest.raises(KeycmdError, match="MISSING alias key G"):
+        sort_aliases(keys, {"C": {"key": "G"}})
+    with pytest.raises(KeycmdError, match="CIRCULAR aliases D -> E -> D"):
+        sort_aliases(keys, {"C": {"key": "D"}, "D": {"key": "E"}, "E": {"key": "D"}})
+
+
+def test_expose_secrets_chain():
+    conf = {
+        "keys": {"T": {"credential": "c", "username": "u", "format": "key {password}"}},
+        "aliases": {
+            "AUTH": {"key": "T_B64", "format": "Basic {password}"},
+            "T_B64": {"key": "T", "b64": True},
+            "PLAIN": {"key": "T"},
+        },
+    }
+    env = expose_secrets(conf, {("c", "u"): "pw"})
+    assert env == {
+        "T": "key pw",
+        "AUTH": f"Basic {b64('pw')}",
+        "T_B64": b64("pw"),
+        "PLAIN": "pw",
+    }
+    assert list(env) == ["T", "AUTH", "T_B64", "PLAIN"]
+
+
+def test_expose_secrets_memoized(monkeypatch):
+    calls = []
+
+    def counting_b64(value):
+        calls.append(value)
+        return b64(value)
+
+    monkeypatch.setattr("keycmd.creds.b64", counting_b64)
+    conf = {
+        "keys": {"A": {"credential": "c", "username": "u", "b64": True}},
+        "aliases": {
+            **{f"ALIAS{i}": {"key": "A", "b64": True} for i in range(100)},
+            **{f"CHAINED{i}": {"key": "ALIAS0", "b64": True} for i in range(100)},
+        },
+    }
+    env = expose_secrets(conf, {("c", "u"): "p"})
+    assert len(env) == 201
+    assert {env[f"ALIAS{i}"] for i in range(100)} == {b64("p")}
+    assert {env[f"CHAINED{i}"] for i in range(100)} == {b64(b64("p"))}
+    assert calls == ["p", b64("p")]
+
+
+def test_transform_memoized_by_value(monkeypatch):
+    calls = []
+    monkeypatch.setattr("keycmd.creds.b64", lambda value: calls.append(value) or value)
+    src = {"credential": "c", "username": "u"}
+    transforms = {}
+    # equal values that are different objects
+    first, second = "".join(["p", "w"]), "".join(["p", "w"])
+    assert first is not second
+    transform(src, first, None, True, transforms)
+    transform(src, second, None, True, transforms)
+    assert calls == ["pw"]
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_get_passwords(monkeypatch, max_workers):
+    monkeypatch.setattr(keyring, "get_password", lambda c, u: f"{c}:{u}")
+    pairs = [(f"cred{i}", f"user{i}") for i in range(10)]
+    passwords = get_passwords(pairs, max_workers=max_workers)
+    assert passwords == [f"cred{i}:user{i}" for i in range(10)]
+
+
+def test_get_max_workers():
+    assert get_max_workers({"keys": {}}) == DEFAULT_MAX_WORKERS
+    assert get_max_workers({"settings": {"max_workers": 3}}) == 3
+    for invalid in [0, "4", True]:
+        with pytest.raises(KeycmdError):
+            get_max_workers({"settings": {"max_workers": invalid}})
+
+
+def test_get_env_missing_order(monkeypatch):
+    monkeypatch.setattr(
+        keyring, "get_password", lambda c, u: None if c != "present" else "pw"
+    )
+    conf = {
+        "keys": {
+            "A": {"credential": "present", "username": "u"},
+            "B": {"credential": "missing1", "username": "u"},
+            "C": {"credential": "missing2", "username": "u"},
+        }
+    }
+    with pytest.raises(KeycmdError) as exc_info:
+        get_env(conf)
+    assert "missing1" in str(exc_info.value)
+
+
+def test_resolve_passwords_dedup(monkeypatch):
+    calls = []
+
+    def get_password(credential, username):
+        calls.append((credential, username))
+        return "pw"
+
+    monkeypatch.setattr(keyring, "get_password", get_password)
+    conf = {
+        "keys": {
+            "A": {"credential": "cred", "username": "u"},
+            "B": {"credential": "cred", "username": "u", "b64": True},
+            "C": {"credential": "other", "username": "u"},
+        }
+    }
+    assert resolve_passwords(conf) == {("cred", "u"): "pw", ("other", "u"): "pw"}
+    assert sorted(calls) == [("cred", "u"), ("other", "u")]
+
+
+def test_get_passwords_bulk(monkeypatch):
+    class BulkKeyring:
+        calls = 0
+
+        def get_passwords(self, pairs):
+            self.calls += 1
+            return [f"{c}:{u}" for c, u in pairs]
+
+    backend = BulkKeyring()
+    monkeypatch.setattr(keyring, "get_keyring", lambda: backend)
+    pairs = [("a", "b"), ("c", "d")]
+    assert get_passwords(pairs) == ["a:b", "c:d"]
+    assert backend.calls == 1
+
+
+@pytest.fixture
+def slow_keyring(monkeypatch):
+    state = {"calls": [], "running": 0, "max_running": 0}
+    lock = threading.Lock()
+
+    def get_password(credential, username):
+        with lock:
+            state["calls"].append((credential, username))
+            state["running"] += 1
+            state["max_running"] = max(state["max_running"], state["running"])
+        time.sleep(0.5 if credential == "slow" else 0.05)
+        with lock:
+            state["running"] -= 1
+        return f"{credential}:{username}"
+
+    monkeypatch.setattr(keyring, "get_password", get_password)
+    yield state
+
+
+def make_conf(pairs, max_workers=DEFAULT_MAX_WORKERS):
+    return {
+        "settings": {"max_workers": max_workers},
+        "keys": {
+            f"KEY_{i}": {"credential": credential, "username": username}
+            for i, (credential, username) in enumerate(pairs)
+        },
+    }
+
+
+def test_get_secrets_async(slow_keyring):
+    conf = make_conf([(f"cred{i}", "user") for i in range(6)], max_workers=2)
+    secrets = asyncio.run(get_secrets_async(conf))
+    assert secrets == {f"KEY_{i}": f"cred{i}:user" for i in range(6)}
+    assert slow_keyring["max_running"] == 2
+
+
+def test_get_secrets_async_coalesce(slow_keyring):
+    conf = make_conf([("slow", "user")])
+
+    async def main():
+        return await asyncio.gather(*(get_secrets_async(conf) for _ in range(5)))
+
+    assert asyncio.run(main()) == [{"KEY_0": "slow:user"}] * 5
+    assert slow_keyring["calls"] == [("slow", "user")]
+
+
+def test_get_secrets_async_timeout(slow_keyring):
+    conf = make_conf([("slow", "user"), ("fast", "user")])
+    with pytest.raises(KeycmdError, match="TIMEOUT looking up credential slow"):
+        asyncio.run(get_secrets_async(conf, timeout=0.2))
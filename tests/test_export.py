@@ -0,0 +1,46 @@
+import json
+from shutil import which
+from subprocess import run
+
+import pytest
+
+from keycmd import KeycmdError
+from keycmd.export import format_env
+
+tricky = 'it\'s a "test" with $HOME, `ls`, \\n, \\ and\nnewlines ß'
+env = {"FOO": tricky, "BAR": "bar", "OTHER": "not exported"}
+
+
+def test_format_env_json():
+    assert json.loads(format_env(env, ["FOO", "BAR"], "json")) == {
+        "FOO": tricky,
+        "BAR": "bar",
+    }
+
+
+def test_format_env_nul():
+    output = format_env(env, ["FOO", "BAR"], "nul")
+    assert output.split("\0") == [f"FOO={tricky}", "BAR=bar", ""]
+
+
+def test_format_env_quoting():
+    assert format_env(env, ["BAR"], "sh") == "export BAR='bar'\n"
+    assert format_env({"A": "it's"}, ["A"], "sh") == "export A='it'\\''s'\n"
+    assert format_env({"A": "it's \\"}, ["A"], "fish") == "set -gx A 'it\\'s \\\\'\n"
+    assert format_env({"A": "it’s"}, ["A"], "powershell") == "$env:A = 'it’’s'\n"  # noqa: RUF001
+    assert format_env({"A": "it's \\"}, ["A"], "dotenv") == "A='it\\'s \\\\'\n"
+
+
+@pytest.mark.skipif(which("bash") is None, reason="requires bash")
+def test_format_env_sh_roundtrip():
+    script = format_env(env, ["FOO", "BAR"], "sh") + 'printf "%s" "$FOO"'
+    p = run(["bash", "-c", script], capture_output=True, check=True)
+    assert p.stdout.decode("utf-8") == tricky
+
+
+def test_format_env_invalid():
+    with pytest.raises(KeycmdError):
+        format_env({"A-B": "foo"}, ["A-B"], "sh")
+    with pytest.raises(KeycmdError):
+        format_env(env, ["FOO"], "xml")
+    assert format_env({"A-B": "foo"}, ["A-B"], "json")
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from keycmd import KeycmdError, files
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="not supported on windows")
+
+
+@pytest.fixture(autouse=True)
+def secret_files(monkeypatch):
+    monkeypatch.setattr(files, "_files", {})
+    yield
+    files.prune({})
+
+
+def test_create():
+    path = files.create("SECRET", "contents")
+    assert path == files.get_fd_path(files.get_fds()[0])
+    assert os.get_inheritable(files.get_fds()[0])
+    # the file can be read more than once
+    for _ in range(2):
+        with open(path, encoding="utf-8") as fh:
+            assert fh.read() == "contents"
+    assert files.create("SECRET", "contents") == path
+    with pytest.raises(OSError):
+        os.write(files.get_fds()[0], b"more")
+
+
+@pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="requires memfd_create")
+def test_create_large():
+    value = "x" * (4 * 1024 * 1024)
+    with open(files.create("SECRET", value), encoding="utf-8") as fh:
+        assert fh.read() == value
+
+
+def test_create_pipe(monkeypatch):
+    monkeypatch.delattr(os, "memfd_create", raising=False)
+    path = files.create("SECRET", "contents")
+    with open(path, encoding="utf-8") as fh:
+        assert fh.read() == "contents"
+    # pipes are never re-used, as they can only be read once
+    assert files.create("SECRET", "contents") != path
+    with pytest.raises(KeycmdError, match="too large"):
+        files.create("SECRET", "x" * (16 * 1024 * 1024))
+
+
+def test_prune():
+    path = files.create("A", "a")
+    files.create("B", "b")
+    files.prune({"A": path})
+    assert len(files.get_fds()) == 1
+    assert files.create("A", "a") == path
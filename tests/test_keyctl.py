@@ -0,0 +1,90 @@
+import uuid
+
+import keyring
+import pytest
+
+from keycmd import KeycmdError, keyctl
+from keycmd.creds import get_secrets
+
+pytestmark = pytest.mark.skipif(
+    not keyctl.IS_SUPPORTED, reason="the session keyring requires linux"
+)
+
+
+@pytest.fixture
+def pair():
+    pair = (f"keycmd-test-{uuid.uuid4().hex}", "user")
+    if not keyctl.set_password(pair, "probe", 5):
+        pytest.skip("the session keyring is not available")
+    yield pair
+
+
+def test_get_ttl():
+    assert keyctl.get_ttl({"keys": {}}) == 0
+    assert keyctl.get_ttl({"settings": {"session_cache": 300}}) == 300
+    for ttl in (-1, 1.5, "300", True):
+        with pytest.raises(KeycmdError, match="INVALID setting session_cache"):
+            keyctl.get_ttl({"settings": {"session_cache": ttl}})
+
+
+def test_describe():
+    description = keyctl.describe(("credential", "user"))
+    assert description.startswith(b"keycmd:")
+    assert b"credential" not in description
+    assert description != keyctl.describe(("credential", "other"))
+
+
+def test_roundtrip(pair):
+    assert keyctl.get_password(pair) == "probe"
+    keyctl.set_passwords({pair: "pässword"}, 5)
+    assert keyctl.get_passwords([pair, ("keycmd-test-missing", "user")]) == [
+        "pässword",
+        None,
+    ]
+
+
+def test_get_secrets(monkeypatch, pair):
+    calls = []
+
+    def get_password(credential, username):
+        calls.append(credential)
+        return "secret"
+
+    monkeypatch.setattr(keyring, "get_password", get_password)
+    monkeypatch.setenv("KEYCMD_AGENT_SOCK", "/nonexistent/agent.sock")
+    other = f"{pair[0]}-other"
+    conf = {
+        "keys": {
+            "A": {"credential": pair[0], "username": "user"},
+            "B": {"credential": other, "username": "user"},
+        },
+        "settings": {"session_cache": 5, "max_workers": 1},
+    }
+    assert get_secrets(conf) == {"A": "probe", "B": "secret"}
+    assert calls == [other]
+    assert keyctl.get_password((other, "user")) == "secret"
+
+    # refresh skips reading the session keyring, but updates it
+    calls.clear()
+    assert get_secrets(conf, refresh=True) == {"A": "secret", "B": "secret"}
+    assert sorted(calls) == sorted([pair[0], other])
+    assert keyctl.get_password(pair) == "secret"
+
+
+def test_get_password_grown(monkeypatch):
+    import ctypes
+
+    payloads = [b"short", b"a longer secret"]
+
+    def syscall(number, operation, *args):
+        if operation == keyctl.KEYCTL_SEARCH:
+            return 1
+        _, buffer, size = args
+        # the key is updated by another process after the first read
+        payload = payloads[0] if buffer is None else payloads[-1]
+        if buffer is not None:
+            ctypes.memmove(buffer, payload, min(size, len(payload)))
+        return len(payload)
+
+    monkeypatch.setattr(keyctl, "syscall", syscall)
+    assert keyctl.get_password(("credential", "user")) == "a longer secret"
@@ -1,8 +1,24 @@
+import json
 from functools import partial
 
 import pytest
 
-from keycmd.logs import error, log, set_verbose, vlog, vwarn
+from keycmd import KeycmdError
+from keycmd.logs import (
+    NullSpan,
+    Pretty,
+    add_secret,
+    close_log_sink,
+    error,
+    log,
+    report_timings,
+    set_log_sink,
+    set_timings,
+    set_verbose,
+    span,
+    vlog,
+    vwarn,
+)
 
 
 def test_logging(capsys, request):
@@ -30,3 +46,101 @@ def test_logging(capsys, request):
 
     vlog("foo")
     assert capsys.readouterr().out == ""
+
+
+def test_lazy_logging(capsys, request):
+    calls = []
+
+    def message():
+        calls.append(1)
+        return "lazy"
+
+    vlog(message)
+    vlog("%s and %r", "foo", "bar")
+    assert capsys.readouterr().out == ""
+    assert calls == []
+
+    set_verbose()
+    request.addfinalizer(partial(set_verbose, False))
+    vlog(message)
+    vlog("%s and %r", "foo", "bar")
+    vlog("%s", Pretty({"a": 1}))
+    assert capsys.readouterr().out == (
+        "keycmd: lazy\nkeycmd: foo and 'bar'\nkeycmd: {'a': 1}\n"
+    )
+    assert calls == [1]
+
+
+def test_log_sink(capsys, tmp_path, request):
+    with pytest.raises(KeycmdError, match="INVALID log sink"):
+        set_log_sink("xml:foo")
+
+    path = tmp_path / "log.jsonl"
+    set_log_sink(f"json:{path}")
+    request.addfinalizer(close_log_sink)
+    add_secret("hunter2")
+    vlog("loading %s", "foo", event="config_loaded", path="foo")
+    vlog("leaking hunter2", event="key_exposed", key="A", password="s3cret")
+    vwarn("careful")
+    log("info")
+    # nothing is printed unless verbose
+    assert capsys.readouterr().out == "keycmd: info\n"
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    for record in records:
+        assert isinstance(record.pop("ts"), float)
+    assert records == [
+        {
+            "level": "debug",
+            "event": "config_loaded",
+            "msg": "loading foo",
+            "path": "foo",
+        },
+        {
+            "level": "debug",
+            "event": "key_exposed",
+            "msg": "leaking ***",
+            "key": "A",
+            "password": "***",
+        },
+        {"level": "warning", "msg": "warning: careful"},
+        {"level": "info", "msg": "info"},
+    ]
+
+
+def test_timings_disabled(capsys):
+    assert isinstance(span("foo"), NullSpan)
+    with span("foo"):
+        pass
+    report_timings()
+    assert capsys.readouterr().err == ""
+
+
+def test_timings(capsys, tmp_path, request):
+    trace_path = tmp_path / "trace.json"
+    request.addfinalizer(report_timings)
+    set_timings(summary=True, trace_path=trace_path)
+    with span("foo", bar="baz"):
+        pass
+    with span("foo"):
+        pass
+    report_timings()
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0].split()[1:] == ["phase", "count", "total", "ms"]
+    assert [line.split()[1:3] for line in lines[1:3]] == [
+        ["imports", "1"],
+        ["foo", "2"],
+    ]
+    assert lines[-1].split()[1] == "wall"
+
+    trace = json.loads(trace_path.read_text(encoding="utf-8"))
+    events = trace["traceEvents"]
+    assert [event["name"] for event in events] == ["imports", "foo", "foo"]
+    assert events[1]["ph"] == "X"
+    assert events[1]["args"] == {"bar": "baz"}
+
+    # timings are only reported once
+    report_timings()
+    assert capsys.readouterr().err == ""
+    assert isinstance(span("foo"), NullSpan)
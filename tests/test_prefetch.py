@@ -0,0 +1,101 @@
+import threading
+from pathlib import Path
+
+import keyring
+import pytest
+
+import keycmd.conf
+from keycmd.conf import Overlay, load_conf
+from keycmd.prefetch import Prefetcher
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    lookups = []
+    release = threading.Event()
+
+    def get_password(credential, username):
+        lookups.append(credential)
+        release.wait(5)
+        return f"{credential}:{username}"
+
+    monkeypatch.setattr(keyring, "get_password", get_password)
+    monkeypatch.setenv("KEYCMD_AGENT_SOCK", "/nonexistent/agent.sock")
+    yield lookups, release
+    release.set()
+
+
+def key(credential):
+    return {"credential": credential, "username": "u"}
+
+
+def test_prefetch(lookups):
+    _, release = lookups
+    prefetcher = Prefetcher()
+    layers = [({"keys": {"A": key("a"), "B": key("b")}}, "first")]
+    prefetcher.add_layer(Overlay(layers))
+    assert len(prefetcher.futures) == 2
+    # overriding a key cancels its lookup, new keys are looked up right away
+    layers.append(
+        ({"keys": {"B": key("b2"), "V": {**key("v"), "source": "vault"}}}, "second")
+    )
+    prefetcher.add_layer(Overlay(layers))
+    assert {pair for pair, _ in prefetcher.futures} == {("a", "u"), ("b2", "u")}
+    release.set()
+    assert prefetcher.collect(Overlay(layers)) == {
+        ("a", "u"): "a:u",
+        ("b2", "u"): "b2:u",
+    }
+
+
+def test_prefetch_settings_changed(lookups):
+    _, release = lookups
+    prefetcher = Prefetcher()
+    layers = [({"keys": {"A": key("a")}}, "first")]
+    prefetcher.add_layer(Overlay(layers))
+    futures = list(prefetcher.futures.values())
+    layers.append(({"settings": {"hedge_ms": 10}}, "second"))
+    prefetcher.add_layer(Overlay(layers))
+    assert futures[0] not in prefetcher.futures.values()
+    release.set()
+    assert prefetcher.collect(Overlay(layers)) == {("a", "u"): "a:u"}
+    # lookups that were not selected in the end are ignored
+    prefetcher = Prefetcher()
+    prefetcher.add_layer(Overlay(layers))
+    assert prefetcher.collect({"keys": {}}) == {}
+
+
+def test_prefetch_invalid_settings(lookups):
+    prefetcher = Prefetcher()
+    prefetcher.add_layer({"keys": {"A": key("a")}, "settings": {"max_workers": 0}})
+    assert prefetcher.disabled
+    assert prefetcher.collect({"keys": {"A": key("a")}}) == {}
+
+
+def test_load_conf_on_layer(tmp_path, monkeypatch):
+    monkeypatch.setattr(keycmd.conf, "USERPROFILE", tmp_path)
+    (tmp_path / ".keycmd").write_text(
+        '[keys]\nA = { credential = "a", username = "u" }\n'
+    )
+    cwd = tmp_path / "project"
+    cwd.mkdir()
+    (cwd / ".keycmd").write_text('[keys]\nA = { credential = "b" }\n')
+    seen = []
+    conf = load_conf(cwd=cwd, on_layer=lambda conf: seen.append(conf["keys"]["A"]))
+    assert seen == [key("a"), key("b")]
+    assert conf["keys"]["A"] == key("b")
+    assert Path(conf.source("keys")) == cwd / ".keycmd"
+
+
+def test_prefetch_selection(lookups):
+    _, release = lookups
+    prefetcher = Prefetcher(profiles=["p"])
+    layers = [({"keys": {"A": key("a"), "B": key("b")}}, "first")]
+    # the profile is not known yet
+    prefetcher.add_layer(Overlay(layers))
+    assert not prefetcher.futures
+    layers.append(({"profiles": {"p": {"keys": ["A"]}}}, "second"))
+    prefetcher.add_layer(Overlay(layers))
+    assert {pair for pair, _ in prefetcher.futures} == {("a", "u")}
+    release.set()
+    prefetcher.collect(Overlay(layers))
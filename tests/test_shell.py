@@ -1,10 +1,21 @@
+import os
 from os import environ
+from pathlib import Path
 from shutil import which
 
 import pytest
 
+import keycmd.cache
 import keycmd.shell
-from keycmd.shell import get_shell, run_cmd, run_shell
+from keycmd.shell import (
+    get_direct_args,
+    get_shell,
+    get_shell_key,
+    run_cmd,
+    run_cmds,
+    run_shell,
+    start_detection,
+)
 
 
 @pytest.fixture
@@ -19,6 +30,53 @@ def test_get_shell():
     assert len(name)
 
 
+def test_get_shell_override():
+    assert get_shell(shell="/bin/bash") == ("bash", "/bin/bash")
+    assert get_shell(shell="CMD.EXE") == ("cmd", "CMD.EXE")
+
+
+def test_get_shell_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(keycmd.cache, "CACHE_DIR", tmp_path)
+    detected = get_shell()
+    assert get_shell(use_cache=True) == detected
+    assert (tmp_path / keycmd.shell.SHELL_CACHE_FILE).is_file()
+
+    def fail():
+        raise AssertionError("shell should not be detected again")
+
+    monkeypatch.setattr(keycmd.shell, "detect_parent_shell", fail)
+    assert get_shell(use_cache=True) == detected
+    assert get_shell_key() == get_shell_key()
+
+    monkeypatch.setenv("SHELL", "/some/other/shell")
+    with pytest.raises(AssertionError):
+        get_shell(use_cache=True)
+
+
+def test_start_detection(monkeypatch):
+    calls = []
+
+    def detect_parent_shell():
+        calls.append(True)
+        return "fakesh", "/bin/fakesh"
+
+    monkeypatch.setattr(keycmd.shell, "detect_parent_shell", detect_parent_shell)
+    start_detection()
+    # a configured shell doesn't wait for the detection
+    assert get_shell(shell="/bin/bash") == ("bash", "/bin/bash")
+    assert get_shell() == ("fakesh", "/bin/fakesh")
+    assert keycmd.shell._detection is None
+    assert len(calls) == 1
+
+    def fail():
+        raise RuntimeError("detection failed")
+
+    monkeypatch.setattr(keycmd.shell, "detect_parent_shell", fail)
+    start_detection()
+    with pytest.raises(RuntimeError, match="detection failed"):
+        get_shell()
+
+
 def test_run_shell(subprocess):
     with pytest.raises(SystemExit) as exc_info:
         run_shell()
@@ -61,3 +119,80 @@ def test_run_cmd_env(capfd, subprocess):
         run_cmd(["echo", var])
     assert exc_info.value.args[0] == 0
     assert capfd.readouterr().out.strip() == expected_without_env
+
+
+def test_get_direct_args():
+    assert get_direct_args(['python -c "pass"']) is None
+    python = which("python")
+    assert get_direct_args(["python --version"]) == [python, "--version"]
+    assert get_direct_args(["python", "--foo=bar"]) == [python, "--foo=bar"]
+    assert get_direct_args(["echo $FOO"]) is None
+    assert get_direct_args(["python", ">", "out.txt"]) is None
+    assert get_direct_args(["FOO=bar", "python"]) is None
+    assert get_direct_args(["cd", ".."]) is None or which("cd") is not None
+    assert get_direct_args(["sadfdasfsdf"]) is None
+    assert get_direct_args(["python"], env={"PATH": ""}) is None
+
+
+@pytest.mark.skipif(os.name == "nt", reason="no executable bit on Windows")
+def test_get_direct_args_path(tmpdir):
+    program = Path(tmpdir) / "keycmd-test-program"
+    program.write_text("#!/bin/sh\n", encoding="utf-8")
+    program.chmod(0o755)
+    args = get_direct_args(["keycmd-test-program", "foo"], env={"PATH": str(tmpdir)})
+    assert args == [str(program), "foo"]
+
+
+def test_get_direct_args_windows(monkeypatch):
+    programs = {"foo": r"C:\bin\foo.EXE", "bar": r"C:\bin\bar.bat"}
+    monkeypatch.setattr("shutil.which", lambda name, path=None: programs[name])
+    with monkeypatch.context() as m:
+        m.setattr(os, "name", "nt")
+        foo = get_direct_args(["foo", "baz"])
+        bar = get_direct_args(["bar", "baz"])
+    assert foo == [r"C:\bin\foo.EXE", "baz"]
+    assert bar is None
+
+
+def test_run_cmd_direct(capfd, subprocess, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("shell should not be detected")
+
+    monkeypatch.setattr(keycmd.shell, "get_shell", fail)
+    with pytest.raises(SystemExit) as exc_info:
+        run_cmd(["python", "--version"], direct=True)
+    assert exc_info.value.args[0] == 0
+    assert capfd.readouterr().out.strip().startswith("Python")
+
+
+def test_run_cmds(capfd):
+    cmds = [["python --version"], ["python -c 'import sys; sys.exit(3)'"]]
+    if get_shell()[0] == "cmd":
+        cmds[1] = ['python -c "import sys; sys.exit(3)"']
+    with pytest.raises(SystemExit) as exc_info:
+        run_cmds(cmds, jobs=2)
+    assert exc_info.value.args[0] == 3
+    assert capfd.readouterr().out.strip().startswith("[1] Python")
+
+    with pytest.raises(SystemExit) as exc_info:
+        run_cmds([["python --version"]] * 3, jobs=2, direct=True)
+    assert exc_info.value.args[0] == 0
+    lines = sorted(capfd.readouterr().out.splitlines())
+    assert [line[:4] for line in lines] == ["[1] ", "[2] ", "[3] "]
+
+
+def test_run_cmds_default_jobs(capfd, monkeypatch):
+    import concurrent.futures
+
+    sizes = []
+
+    class Pool(concurrent.futures.ThreadPoolExecutor):
+        def __init__(self, max_workers=None):
+            sizes.append(max_workers)
+            super().__init__(max_workers=max_workers)
+
+    monkeypatch.setattr(concurrent.futures, "ThreadPoolExecutor", Pool)
+    monkeypatch.setattr(keycmd.shell.os, "cpu_count", lambda: 3)
+    with pytest.raises(SystemExit):
+        run_cmds([["python --version"]], direct=True)
+    assert sizes == [3]
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from keycmd import KeycmdError, vault
+from keycmd.creds import get_secrets
+
+
+@pytest.fixture
+def vault_path(tmp_path, monkeypatch):
+    pytest.importorskip("cryptography")
+    path = tmp_path / "vault"
+    monkeypatch.setenv("KEYCMD_VAULT", str(path))
+    monkeypatch.setenv("KEYCMD_VAULT_PASSPHRASE", "hunter2")
+    monkeypatch.delenv("KEYCMD_VAULT_KEY_FILE", raising=False)
+    monkeypatch.setattr(vault, "SCRYPT_N", 2**10)
+    yield path
+
+
+def test_get_vault_path(vault_path, monkeypatch):
+    assert vault.get_vault_path() == vault_path
+    monkeypatch.delenv("KEYCMD_VAULT")
+    conf = {"settings": {"vault": "~/secrets.vault"}}
+    assert vault.get_vault_path(conf).name == "secrets.vault"
+    assert vault.get_vault_path().name == ".keycmd-vault"
+
+
+def test_vault(vault_path):
+    vault.set_password("cred", "user", "passwordß")
+    vault.import_passwords({("cred", "other"): "other", ("cred2", "user"): "2"})
+    if os.name != "nt":
+        assert vault_path.stat().st_mode & 0o777 == 0o600
+    assert b"password" not in vault_path.read_bytes()
+    assert vault.get_passwords(
+        [("cred", "user"), ("cred", "other"), ("cred2", "user"), ("cred", "missing")]
+    ) == ["passwordß", "other", "2", None]
+
+
+def test_vault_key_file(vault_path, tmp_path, monkeypatch):
+    key_file = tmp_path / "key"
+    key_file.write_bytes(b"secret key\n")
+    monkeypatch.delenv("KEYCMD_VAULT_PASSPHRASE")
+    monkeypatch.setenv("KEYCMD_VAULT_KEY_FILE", str(key_file))
+    vault.set_password("cred", "user", "password")
+    monkeypatch.delenv("KEYCMD_VAULT_KEY_FILE")
+    monkeypatch.setenv("KEYCMD_VAULT_PASSPHRASE", "secret key")
+    assert vault.get_passwords([("cred", "user")]) == ["password"]
+
+
+def test_vault_wrong_passphrase(vault_path, monkeypatch):
+    vault.set_password("cred", "user", "password")
+    monkeypatch.setenv("KEYCMD_VAULT_PASSPHRASE", "wrong")
+    with pytest.raises(KeycmdError, match="wrong passphrase"):
+        vault.get_passwords([("cred", "user")])
+
+
+def test_get_secrets_vault(vault_path, monkeypatch):
+    vault.set_password("cred", "user", "from vault")
+    calls = []
+    monkeypatch.setattr(
+        "keyring.get_password", lambda *pair: calls.append(pair) or "from keyring"
+    )
+    conf = {
+        "keys": {
+            "A": {"credential": "cred", "username": "user", "source": "vault"},
+            "B": {"credential": "cred", "username": "user"},
+        },
+        "aliases": {"C": {"key": "A", "b64": True}},
+    }
+    assert get_secrets(conf) == {
+        "A": "from vault",
+        "B": "from keyring",
+        "C": "ZnJvbSB2YXVsdA==",
+    }
+    assert calls == [("cred", "user")]
+
+    conf["keys"]["A"]["source"] = "nope"
+    with pytest.raises(KeycmdError, match="INVALID source 'nope'"):
+        get_secrets(conf)
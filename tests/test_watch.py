@@ -0,0 +1,126 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+import keyring
+import pytest
+
+import keycmd.conf
+from keycmd import watch
+from keycmd.conf import load_conf
+
+CHILD = """
+import os, sys, time
+with open("log.txt", "a") as fh:
+    fh.write(os.environ["__KEYCMD_WATCH"] + "\\n")
+if os.environ["__KEYCMD_WATCH"] == sys.argv[1]:
+    sys.exit(3)
+time.sleep(30)
+"""
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    user_dir = tmp_path / ".user"
+    user_dir.mkdir()
+    monkeypatch.setattr(keycmd.conf, "USERPROFILE", user_dir)
+    monkeypatch.setenv("KEYCMD_AGENT_SOCK", str(tmp_path / "agent.sock"))
+    monkeypatch.setattr(watch, "DEBOUNCE", 0.1)
+    monkeypatch.setattr(watch, "FILE_POLL_INTERVAL", 0.1)
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / ".git").mkdir()
+    (project / ".keycmd").write_text(
+        '[keys]\n__KEYCMD_WATCH = { credential = "a", username = "u" }\n',
+        encoding="utf-8",
+    )
+    monkeypatch.chdir(project)
+    yield project
+
+
+@pytest.fixture
+def passwords(monkeypatch):
+    passwords = {("a", "u"): "first"}
+    monkeypatch.setattr(
+        keyring, "get_password", lambda *pair: passwords.get(pair, f"{pair}")
+    )
+    yield passwords
+
+
+def run_watch(expected, change, interval=60.0):
+    def later():
+        # wait for the first child to start
+        while not Path("log.txt").exists():
+            time.sleep(0.05)
+        change()
+
+    thread = threading.Thread(target=later)
+    thread.start()
+    args = [sys.executable, "-c", CHILD, expected]
+    code = watch.watch(args, load_conf(), load_conf, interval=interval)
+    thread.join()
+    return code, Path("log.txt").read_text().splitlines()
+
+
+def test_open_inotify_unsupported(monkeypatch):
+    monkeypatch.setattr(sys, "platform", "win32")
+    assert watch.open_inotify() is None
+
+
+def test_read_events(tmp_path):
+    inotify = watch.open_inotify()
+    if inotify is None:
+        pytest.skip("inotify is not supported")
+    watch.add_watches(inotify, [tmp_path])
+    (tmp_path / "other.txt").touch()
+    assert not watch.read_events(inotify[1], {".keycmd"})
+    (tmp_path / ".keycmd").touch()
+    assert watch.read_events(inotify[1], {".keycmd"})
+
+
+def test_watch_credential(project, passwords):
+    def rotate():
+        passwords["a", "u"] = "rotated"
+
+    code, log = run_watch("rotated", rotate, interval=0.2)
+    assert code == 3
+    assert log == ["first", "rotated"]
+
+
+def test_watch_credential_failure(project, passwords, monkeypatch):
+    failures = []
+    get_password = keyring.get_password
+
+    def flaky(*pair):
+        if failures:
+            failures.pop()
+            raise RuntimeError("keyring is locked")
+        return get_password(*pair)
+
+    monkeypatch.setattr(keyring, "get_password", flaky)
+
+    def rotate():
+        failures.append(True)
+        passwords["a", "u"] = "rotated"
+
+    code, log = run_watch("rotated", rotate, interval=0.2)
+    assert code == 3
+    assert log == ["first", "rotated"]
+    assert not failures
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watch_conf(project, passwords, monkeypatch, inotify):
+    if not inotify:
+        monkeypatch.setattr(watch, "open_inotify", lambda: None)
+
+    def edit():
+        (project / ".keycmd").write_text(
+            '[keys]\n__KEYCMD_WATCH = { credential = "b", username = "u" }\n',
+            encoding="utf-8",
+        )
+
+    code, log = run_watch("('b', 'u')", edit)
+    assert code == 3
+    assert log == ["first", "('b', 'u')"]